@@ -0,0 +1,316 @@
+'''
+Benchmarks of refresh cycles and first listings against a mock GitHub
+
+An organization of each size is served by mock_github, and an unmounted
+GithubFileSystem is pointed at it with empty caches.  For each size, the
+median latency of the first listing of tags, a tag's tree and branches,
+and of the first read of a file, is measured over a sample of
+repositories.  Then the time and GitHub requests of two refreshes are
+reported, which also update the tags and branches of the sample: a cold
+one with nothing cached, and a warm one with everything cached but past
+its max_age, so that every listing is revalidated.
+
+With `memory`, the memory taken per inode is measured instead, over a
+synthetic tree generated in full (see synthetic.py): as allocated by
+Python (tracemalloc) and as the growth of the process's resident set.
+
+With `listing`, a synthetic directory of --entries files is listed in
+chunks of --chunk bytes, as the kernel reads it: with listings packed
+once and sliced per chunk, and with every entry packed again per chunk.
+
+Usage:
+  benchmark.py [-v] [--repos=<list>] [--tags=<n>] [--latency=<s>]
+               [--samples=<n>] [--graphql]
+  benchmark.py [-v] memory [--depth=<n>] [--dirs=<n>] [--files=<n>]
+               [--links=<n>]
+  benchmark.py [-v] listing [--entries=<n>] [--chunk=<bytes>]
+
+Options:
+  --repos=<list>   comma-delimited organization sizes [default: 10,100,1000].
+  --tags=<n>       number of tags in each repository [default: 20].
+  --latency=<s>    mock API latency per request in seconds [default: 0.02].
+  --samples=<n>    repositories sampled for first listings [default: 5].
+  --graphql        list tags with the GraphQL API.
+  --depth=<n>      levels of directories [default: 3].
+  --dirs=<n>       subdirectories of each directory [default: 10].
+  --files=<n>      files in each directory [default: 100].
+  --links=<n>      symlinks in each directory [default: 10].
+  --entries=<n>    files in the listed directory [default: 20000].
+  --chunk=<bytes>  size of each readdir request [default: 4096].
+'''
+
+import os
+import gc
+import time
+import shutil
+import asyncio
+import logging
+import tempfile
+import threading
+import statistics
+import tracemalloc
+
+from . import cache
+from . import ghclient
+from .blobstore import BlobStore
+from .githubfs import GithubFileSystem
+from .mock_github import MockGithub
+from .dirbuf import DirectoryListing, _dirent
+from .synthetic import SyntheticFileSystem
+
+
+logger = logging.getLogger(__name__)
+
+
+def _request_count():
+    return ghclient.counters['requests'] + ghclient.counters['graphql']
+
+
+def _time_first_use(fs, obj):
+    '''Seconds until `obj` is loaded and, for directories, listed'''
+    t0 = time.perf_counter()
+    fut = obj.ensure_loaded()
+    if fut is not None:
+        fut.result()
+    if hasattr(obj, 'get_entries'):
+        fs.get_listing(obj)
+    return time.perf_counter() - t0
+
+
+def run_benchmark(num_repos, *, num_tags=20, latency=0.02, samples=5,
+                  graphql=False):
+    '''Benchmark an organization of `num_repos` repositories
+
+    Returns a dictionary of results.
+    '''
+    mock = MockGithub(num_repos=num_repos, num_tags=num_tags,
+                      latency=latency)
+    mock_loop = asyncio.new_event_loop()
+    mock_thread = threading.Thread(target=mock_loop.run_forever, daemon=True)
+    mock_thread.start()
+    base_url = asyncio.run_coroutine_threadsafe(mock.start(),
+                                                mock_loop).result()
+
+    tempdir = tempfile.mkdtemp(prefix='gitfuse-benchmark-')
+    saved = (ghclient.api_url, ghclient.use_graphql, cache.backend)
+    ghclient.api_url = base_url
+    ghclient.use_graphql = graphql
+    # empty, not migrated from any cache files in the working directory
+    cache.set_backend(cache.SQLiteBackend(os.path.join(tempdir, 'cache.db'),
+                                          migrate_from={}))
+
+    fs = GithubFileSystem(None, organizations=['bench'], mount=False,
+                          auto_update=False,
+                          blob_store=BlobStore(os.path.join(tempdir,
+                                                            'blobs')))
+    try:
+        results = dict(repos=num_repos)
+        fs.run(fs.update())
+
+        # first listings of a sample, whose tags and branches are then kept
+        # up to date by each refresh
+        owner_dir = fs.orgs['bench'].obj
+        repo_names = sorted(owner_dir.entry_by_name)
+        step = max(len(repo_names) // samples, 1)
+        sampled = repo_names[::step][:samples]
+        timings = dict(tags=[], tree=[], branches=[], read=[])
+        requests0 = _request_count()
+        for repo_name in sampled:
+            repo_dir = owner_dir[repo_name].obj
+            tag_dir = repo_dir['tags'].obj
+            timings['tags'].append(_time_first_use(fs, tag_dir))
+            tree = tag_dir[sorted(tag_dir.entry_by_name)[0]].obj
+            timings['tree'].append(_time_first_use(fs, tree))
+            timings['branches'].append(
+                _time_first_use(fs, repo_dir['branches'].obj))
+            readme = tree['README.md'].obj
+            timings['read'].append(_time_first_use(fs, readme))
+
+        results['sampled'] = len(timings['tags'])
+        results['sample_requests'] = _request_count() - requests0
+        for key, values in timings.items():
+            results['first_' + key] = statistics.median(values)
+
+        # cold: nothing cached, as on a first mount
+        cache.set_backend(cache.SQLiteBackend(os.path.join(tempdir,
+                                                           'cold.db'),
+                                              migrate_from={}))
+        fs._pushed_at.clear()
+        info = fs.run(fs.update())
+        results['cold_update'] = info['duration']
+        results['cold_requests'] = info['requests']
+
+        # warm: everything cached but past its max_age, so each listing is
+        # revalidated with a conditional request
+        ghclient.expire_repos('bench', org=True)
+        for repo_name in sampled:
+            ghclient.expire_tags('bench', repo_name)
+            ghclient.expire_branches('bench', repo_name)
+        fs._pushed_at.clear()
+        info = fs.run(fs.update())
+        results['warm_update'] = info['duration']
+        results['warm_requests'] = info['requests']
+
+        results['server_requests'] = mock.request_count
+        results['server_not_modified'] = mock.not_modified_count
+        return results
+    finally:
+        fs.destroy(None)
+        ghclient.api_url, ghclient.use_graphql, backend = saved
+        cache.set_backend(backend)
+        asyncio.run_coroutine_threadsafe(mock.stop(), mock_loop).result()
+        mock_loop.call_soon_threadsafe(mock_loop.stop)
+        mock_thread.join()
+        mock_loop.close()
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+
+_columns = [('repos', 'repos', '{:d}'),
+            ('cold_update', 'cold update', '{:.3f} s'),
+            ('cold_requests', 'requests', '{:d}'),
+            ('warm_update', 'warm update', '{:.3f} s'),
+            ('warm_requests', 'requests', '{:d}'),
+            ('first_tags', 'ls tags/', '{:.1f} ms'),
+            ('first_tree', 'ls tags/<tag>/', '{:.1f} ms'),
+            ('first_branches', 'ls branches/', '{:.1f} ms'),
+            ('first_read', 'cat README.md', '{:.1f} ms'),
+            ('sample_requests', 'requests', '{:d}'),
+            ]
+
+
+def format_results(results):
+    rows = [[title for key, title, fmt in _columns]]
+    for result in results:
+        rows.append([fmt.format(result[key] * 1e3 if fmt.endswith('ms')
+                                else result[key])
+                     for key, title, fmt in _columns])
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(_columns))]
+    return '\n'.join('  '.join(value.rjust(width)
+                               for value, width in zip(row, widths))
+                     for row in rows)
+
+
+def _rss():
+    '''Resident set size of this process, in bytes'''
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def _build_tree(tree_options):
+    fs = SyntheticFileSystem(None, mount=False, eager=True, **tree_options)
+    fs.destroy(None)
+    return fs
+
+
+def measure_inodes(**tree_options):
+    '''Memory per inode of an eagerly generated synthetic tree
+
+    The tree is built twice: once to measure the growth of the resident
+    set, and once more with tracemalloc tracing allocations.
+    '''
+    gc.collect()
+    rss0 = _rss()
+    fs = _build_tree(tree_options)
+    rss = _rss() - rss0
+    num_inodes = len(fs.inode_entries)
+    del fs
+    gc.collect()
+
+    tracemalloc.start()
+    try:
+        fs = _build_tree(tree_options)
+        traced, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return dict(inodes=num_inodes,
+                traced_bytes=traced, traced_per_inode=traced / num_inodes,
+                rss_bytes=rss, rss_per_inode=rss / num_inodes)
+
+
+def format_memory(result):
+    return ('{inodes} inodes: {traced_per_inode:.0f} bytes/inode allocated '
+            '({traced_bytes} bytes), {rss_per_inode:.0f} bytes/inode '
+            'resident ({rss_bytes} bytes)'.format(**result))
+
+
+def _list_in_chunks(read, chunk_size):
+    '''Call read(off, size) until the listing is exhausted, as the kernel'''
+    off = 0
+    while True:
+        buf = read(off, chunk_size)
+        if not buf:
+            return off
+        # each entry ends with its index, the next offset to request
+        while buf:
+            ino, off, namelen, type_ = _dirent.unpack_from(buf)
+            size = _dirent.size + namelen
+            buf = buf[size + (-size % 8):]
+
+
+def measure_listing(num_entries, chunk_size=4096):
+    '''Seconds to list a directory of `num_entries` files
+
+    The listing is read in `chunk_size` byte requests, through the cached
+    packed listing and, for comparison, packing every entry per request.
+    '''
+    fs = _build_tree(dict(depth=0, num_dirs=0, num_files=num_entries,
+                          num_links=0))
+    tree = fs.root['tree'].obj
+
+    def packed_read(off, size):
+        return fs.get_listing(tree).read(off, size)
+
+    def repacked_read(off, size):
+        return DirectoryListing(tree.version,
+                                tree.get_entries()).read(off, size)
+
+    result = dict(entries=num_entries, chunk=chunk_size)
+    for key, read in (('repacked', repacked_read),
+                      ('cold', packed_read),
+                      ('warm', packed_read)):
+        t0 = time.perf_counter()
+        _list_in_chunks(read, chunk_size)
+        result[key] = time.perf_counter() - t0
+    return result
+
+
+def format_listing(result):
+    return ('{entries} entries in {chunk} byte chunks: {cold:.3f} s packed '
+            'once, {warm:.3f} s cached, {repacked:.3f} s packed per '
+            'chunk'.format(**result))
+
+
+def main(sizes, **kwargs):
+    results = []
+    for num_repos in sizes:
+        logger.info('Benchmarking %d repositories', num_repos)
+        results.append(run_benchmark(num_repos, **kwargs))
+    print(format_results(results))
+    return results
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__, version='0.1')
+
+    if args['-v']:
+        for loggername in ('gitfuse', '__main__'):
+            logging.getLogger(loggername).setLevel(logging.DEBUG)
+        logging.basicConfig()
+
+    if args['memory']:
+        print(format_memory(measure_inodes(depth=int(args['--depth']),
+                                           num_dirs=int(args['--dirs']),
+                                           num_files=int(args['--files']),
+                                           num_links=int(args['--links']))))
+    elif args['listing']:
+        print(format_listing(measure_listing(int(args['--entries']),
+                                             int(args['--chunk']))))
+    else:
+        main([int(size) for size in args['--repos'].split(',')],
+             num_tags=int(args['--tags']),
+             latency=float(args['--latency']),
+             samples=int(args['--samples']),
+             graphql=args['--graphql'])
@@ -0,0 +1,149 @@
+import os
+import mmap
+import logging
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+
+logger = logging.getLogger(__name__)
+
+
+def default_path():
+    '''The blob store directory under the user's cache directory'''
+    cache_home = (os.environ.get('XDG_CACHE_HOME') or
+                  os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'gitfuse', 'blobs')
+
+
+class BlobStore:
+    '''A content-addressed store of git blobs on disk
+
+    Blobs are stored by SHA under `path` and, being immutable, are never
+    revalidated.  Once the total size exceeds `max_bytes`, the least
+    recently read blobs are removed.  Reads return slices of a memory map of
+    the blob file, so the data is not copied into Python objects.
+    '''
+    def __init__(self, path, *, max_bytes=1 << 30, max_open=256):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_open = max_open
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+        # sha -> size, least recently used first
+        self._sizes = OrderedDict()
+        # sha -> mmap, for recently read blobs
+        self._maps = OrderedDict()
+
+        os.makedirs(path, exist_ok=True)
+        self._scan()
+
+    def _scan(self):
+        found = []
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            prefix = os.path.basename(dirpath)
+            for fn in filenames:
+                if fn.startswith('.'):
+                    # an interrupted write
+                    os.unlink(os.path.join(dirpath, fn))
+                    continue
+
+                st = os.stat(os.path.join(dirpath, fn))
+                found.append((st.st_mtime, prefix + fn, st.st_size))
+
+        for _, sha, size in sorted(found):
+            self._sizes[sha] = size
+            self.total_bytes += size
+
+        if found:
+            logger.debug('Blob store %s has %d blobs (%d bytes)', self.path,
+                         len(found), self.total_bytes)
+        self._evict()
+
+    def _blob_path(self, sha):
+        return os.path.join(self.path, sha[:2], sha[2:])
+
+    def __contains__(self, sha):
+        return sha in self._sizes
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def put(self, sha, data):
+        '''Store the contents of a blob'''
+        path = self._blob_path(sha)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path),
+                                         prefix='.')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+
+        with self._lock:
+            if sha not in self._sizes:
+                self.total_bytes += len(data)
+            self._sizes[sha] = len(data)
+            self._sizes.move_to_end(sha)
+            self._evict(keep=sha)
+
+    def _evict(self, keep=None):
+        while self.total_bytes > self.max_bytes and len(self._sizes) > 1:
+            sha, size = next(iter(self._sizes.items()))
+            if sha == keep:
+                break
+
+            del self._sizes[sha]
+            # readers holding slices of its map keep the data alive
+            self._maps.pop(sha, None)
+            self.total_bytes -= size
+            self.evictions += 1
+            try:
+                os.unlink(self._blob_path(sha))
+            except FileNotFoundError:
+                pass
+
+    def _get_map(self, sha):
+        try:
+            mm = self._maps[sha]
+        except KeyError:
+            pass
+        else:
+            self._maps.move_to_end(sha)
+            return mm
+
+        with open(self._blob_path(sha), 'rb') as f:
+            # a private mapping is writable, which lets ctypes point at it
+            # directly; nothing is ever written to it
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+        self._maps[sha] = mm
+        while len(self._maps) > self.max_open:
+            self._maps.popitem(last=False)
+        return mm
+
+    def read(self, sha, size, offset):
+        '''Read part of a blob, as a memoryview of its memory map
+
+        Raises KeyError if the blob is not in the store.
+        '''
+        with self._lock:
+            try:
+                blob_size = self._sizes[sha]
+            except KeyError:
+                self.misses += 1
+                raise
+
+            self.hits += 1
+            self._sizes.move_to_end(sha)
+            if blob_size == 0 or offset >= blob_size:
+                return b''
+            return memoryview(self._get_map(sha))[offset:offset + size]
+
+    def get_statistics(self):
+        return dict(blobs=len(self._sizes), bytes=self.total_bytes,
+                    max_bytes=self.max_bytes, hits=self.hits,
+                    misses=self.misses, evictions=self.evictions)
@@ -1,75 +1,379 @@
 import os
-import logging
-import weakref
-import atexit
+import re
+import time
 import json
+import atexit
+import logging
+import sqlite3
+import threading
+
+from collections import OrderedDict
 
 
 logger = logging.getLogger(__name__)
 
+# Cache files written by earlier versions, by cache name
+json_filenames = {'user-repo': 'user_repo_cache.json',
+                  'org-repo': 'org_repo_cache.json',
+                  'tags': 'tag_cache.json',
+                  'branches': 'branch_cache.json',
+                  'commits': 'commit_cache.json',
+                  }
 
-class TaggedCache(dict):
-    def __init__(self, fn):
-        self.tags = {}
-        self.fn = fn
 
-        atexit.register(weakref.WeakMethod(self.save))
+class JSONBackend:
+    '''Keeps every cache in memory, written out as one JSON file per cache
+
+    Files are only written by `save`, which is called at exit.
+    '''
+    def __init__(self, filenames=None):
+        if filenames is None:
+            filenames = json_filenames
 
-        if os.path.exists(fn):
+        self.filenames = dict(filenames)
+        self._data = {}
+
+    def _load(self, name):
+        try:
+            return self._data[name]
+        except KeyError:
+            pass
+
+        data = self._data[name] = {}
+        fn = self.filenames.get(name, None)
+        if fn is not None and os.path.exists(fn):
             try:
-                self.load(fn)
+                data.update(load_json_cache(fn, name))
             except Exception as ex:
                 logger.warning('Corrupt tag cache', exc_info=ex)
             else:
                 logger.debug('Loaded tag cache from %s', fn)
+        return data
 
-    def load(self, fn):
-        with open(fn, 'rt') as f:
-            data = json.load(f)
-        self.__setstate__(data)
+    def get(self, name, key):
+        return self._load(name).get(key, None)
 
-    def __getstate__(self):
-        return {'data': dict(self),
-                'tags': self.tags}
+    def set(self, name, key, tag, value):
+        self._load(name)[key] = (tag, value)
 
-    def __setstate__(self, state):
-        assert 'tags' in state
-        assert 'data' in state
+    def set_tag(self, name, key, tag):
+        data = self._load(name)
+        if key in data:
+            data[key] = (tag, data[key][1])
 
-        self.tags.clear()
-        self.clear()
-        self.tags.update(state['tags'])
-        self.update(state['data'])
+    def delete(self, name, key):
+        self._load(name).pop(key, None)
 
-    def save(self, fn=None):
-        if fn is None:
-            fn = self.fn
+    def save(self):
+        for name, data in self._data.items():
+            fn = self.filenames.get(name, None)
+            if fn is None:
+                continue
 
-        with open(fn, 'wt') as f:
-            json.dump(self.__getstate__(), f)
+            state = {'tags': {key: tag for key, (tag, value) in data.items()},
+                     'data': {key: value
+                              for key, (tag, value) in data.items()},
+                     }
+            with open(fn, 'wt') as f:
+                json.dump(state, f)
 
-    def set_with_tag(self, key, tag, value):
-        self.tags[key] = tag
-        self[key] = value
+    close = save
 
 
-caches = {'user-repo': TaggedCache('user_repo_cache.json'),
-          'org-repo': TaggedCache('org_repo_cache.json'),
-          'tags': TaggedCache('tag_cache.json'),
-          'branches': TaggedCache('branch_cache.json'),
-          'commits': TaggedCache('commit_cache.json'),
-          }
+class SQLiteBackend:
+    '''Stores all caches in a single SQLite database
 
+    Entries are read when first requested and written as soon as they are
+    set, so nothing is lost if the process is killed.  The database is
+    opened on first use in write-ahead-log mode; at that point, any cache
+    files from the JSON backend are imported and renamed to *.migrated.
+    '''
+    def __init__(self, fn, *, migrate_from=None):
+        if migrate_from is None:
+            migrate_from = json_filenames
 
-def _cache_cleanup():
-    for name, cache in caches.items():
-        if cache.fn is None:
-            continue
+        self.fn = fn
+        self.migrate_from = dict(migrate_from)
+        self._conn = None
+        self._lock = threading.RLock()
 
+    @property
+    def conn(self):
+        if self._conn is None:
+            conn = sqlite3.connect(self.fn, check_same_thread=False,
+                                   isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('CREATE TABLE IF NOT EXISTS cache ('
+                         'name TEXT NOT NULL, key TEXT NOT NULL, '
+                         'tag TEXT, value TEXT, '
+                         'PRIMARY KEY (name, key)) WITHOUT ROWID')
+            self._conn = conn
+            logger.debug('Opened cache database %s', self.fn)
+            for name, json_fn in self.migrate_from.items():
+                if os.path.exists(json_fn):
+                    self.migrate_json(name, json_fn)
+        return self._conn
+
+    def migrate_json(self, name, fn):
         try:
-            cache.save()
+            data = load_json_cache(fn, name)
         except Exception as ex:
-            logger.error('Failed to save cache: %s', name,
-                         exc_info=ex)
+            logger.warning('Not migrating corrupt tag cache %s', fn,
+                           exc_info=ex)
+            return
+
+        rows = [(name, key, json.dumps(tag), json.dumps(value))
+                for key, (tag, value) in data.items()]
+        with self._lock:
+            self.conn.execute('BEGIN')
+            self.conn.executemany('INSERT OR IGNORE INTO cache '
+                                  'VALUES (?, ?, ?, ?)', rows)
+            self.conn.execute('COMMIT')
+        os.rename(fn, fn + '.migrated')
+        logger.info('Migrated %d entries from %s', len(rows), fn)
+
+    def get(self, name, key):
+        with self._lock:
+            row = self.conn.execute('SELECT tag, value FROM cache '
+                                    'WHERE name=? AND key=?',
+                                    (name, key)).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), json.loads(row[1])
+
+    def set(self, name, key, tag, value):
+        with self._lock:
+            self.conn.execute('INSERT OR REPLACE INTO cache '
+                              'VALUES (?, ?, ?, ?)',
+                              (name, key, json.dumps(tag),
+                               json.dumps(value)))
+
+    def set_tag(self, name, key, tag):
+        with self._lock:
+            self.conn.execute('UPDATE cache SET tag=? WHERE name=? AND key=?',
+                              (json.dumps(tag), name, key))
+
+    def delete(self, name, key):
+        with self._lock:
+            self.conn.execute('DELETE FROM cache WHERE name=? AND key=?',
+                              (name, key))
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+_sha1 = re.compile('^[0-9a-f]{40}$')
+
+
+def migrate_key(name, key):
+    '''The key of an entry of cache `name`, given as written by any version
+
+    Earlier versions cached listings as a single page under the listing's
+    key, where they are now cached page by page under '<key>?page=<n>', and
+    commits under their URL rather than their SHA.  Returns None for keys
+    with no equivalent.
+    '''
+    if '?page=' in key:
+        return key
+
+    parts = key.split('/')
+    if name in ('user-repo', 'org-repo'):
+        # the owner, listed with its repositories
+        return (key + '?page=1') if len(parts) == 1 else None
+    elif name in ('tags', 'branches'):
+        if len(parts) == 4 and parts[0] == 'repos' and parts[3] == name:
+            return key + '?page=1'
+        elif name == 'branches' and len(parts) == 5 and parts[0] == 'repos':
+            # a single branch, as ever
+            return key
+        return None
+    elif name == 'commits':
+        return parts[-1] if _sha1.match(parts[-1]) else None
+    return key
+
+
+def load_json_cache(fn, name=None):
+    '''Load a cache file written by the JSON backend as {key: (tag, value)}
+
+    With the `name` of the cache, keys of earlier versions are migrated and
+    entries that cannot be are dropped.
+    '''
+    with open(fn, 'rt') as f:
+        state = json.load(f)
+
+    assert 'tags' in state
+    assert 'data' in state
+    tags = state['tags']
+    data = {}
+    for key, value in state['data'].items():
+        new_key = (key if name is None else migrate_key(name, key))
+        if new_key is None:
+            logger.debug('Dropping %s cache entry %r', name, key)
+        else:
+            data[new_key] = (tags.get(key, None), value)
+    return data
+
+
+class _TagView:
+    '''Read-only mapping of cache key to tag'''
+    def __init__(self, cache):
+        self._cache = cache
+
+    def __getitem__(self, key):
+        return self._cache._get_record(key)[0]
+
+    def __contains__(self, key):
+        return key in self._cache
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+
+class TaggedCache:
+    '''A cache of values, each stored with a tag (e.g., an ETag or timestamp)
+
+    Entries are read through from and written through to `backend`, if set.
+    At most `max_entries` are held in memory, least recently used first
+    out, and entries unused for `ttl` seconds are dropped from memory.
+    Evicted entries remain in the backend and are read again on demand.
+    '''
+    def __init__(self, name, backend=None, *, max_entries=None, ttl=None):
+        self.name = name
+        self.backend = backend
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.tags = _TagView(self)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key -> (tag, value, last_used), least recently used first
+        self._data = OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def _get_record(self, key):
+        now = time.monotonic()
+        try:
+            tag, value, last_used = self._data[key]
+        except KeyError:
+            pass
+        else:
+            if self.ttl is None or now - last_used < self.ttl:
+                self.hits += 1
+                self._data[key] = (tag, value, now)
+                self._data.move_to_end(key)
+                return tag, value
+
+            del self._data[key]
+            self.evictions += 1
+
+        self.misses += 1
+        record = None
+        if self.backend is not None:
+            record = self.backend.get(self.name, key)
+        if record is None:
+            raise KeyError(key)
+
+        tag, value = record
+        self._insert(key, tag, value)
+        return tag, value
+
+    def _insert(self, key, tag, value):
+        now = time.monotonic()
+        self._data[key] = (tag, value, now)
+        self._data.move_to_end(key)
+
+        data = self._data
+        if self.ttl is not None:
+            while data:
+                _, (_, _, last_used) = next(iter(data.items()))
+                if now - last_used < self.ttl:
+                    break
+                data.popitem(last=False)
+                self.evictions += 1
+
+        if self.max_entries is not None:
+            while len(data) > self.max_entries:
+                data.popitem(last=False)
+                self.evictions += 1
+
+    def __getitem__(self, key):
+        return self._get_record(key)[1]
+
+    def get_with_tag(self, key):
+        '''Returns (tag, value), raising KeyError if `key` is not cached'''
+        return self._get_record(key)
+
+    def __contains__(self, key):
+        try:
+            self._get_record(key)
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def set_with_tag(self, key, tag, value):
+        self._insert(key, tag, value)
+        if self.backend is not None:
+            self.backend.set(self.name, key, tag, value)
+
+    def set_tag(self, key, tag):
+        '''Replace the tag of a cached entry, keeping its value'''
+        _, value = self._get_record(key)
+        self._insert(key, tag, value)
+        if self.backend is not None:
+            self.backend.set_tag(self.name, key, tag)
+
+    def discard(self, key):
+        self._data.pop(key, None)
+        if self.backend is not None:
+            self.backend.delete(self.name, key)
+
+    def get_statistics(self):
+        return dict(entries=len(self._data), hits=self.hits,
+                    misses=self.misses, evictions=self.evictions)
+
+
+backend = SQLiteBackend(os.environ.get('GITFUSE_CACHE', 'gitfuse_cache.db'))
+# In-memory limits by cache name; everything stays in the backend
+cache_limits = {'user-repo': dict(max_entries=200, ttl=None),
+                'org-repo': dict(max_entries=200, ttl=None),
+                'tags': dict(max_entries=2000, ttl=3600.0),
+                'branches': dict(max_entries=2000, ttl=3600.0),
+                'commits': dict(max_entries=5000, ttl=600.0),
+                'trees': dict(max_entries=5000, ttl=600.0),
+                }
+caches = {name: TaggedCache(name, backend, **limits)
+          for name, limits in cache_limits.items()}
+
+
+def set_backend(new_backend):
+    '''Switch all caches to a different storage backend'''
+    global backend
+    backend.close()
+    backend = new_backend
+    for cache in caches.values():
+        cache.backend = new_backend
+        cache._data.clear()
+
+
+def _cache_cleanup():
+    try:
+        backend.close()
+    except Exception as ex:
+        logger.error('Failed to close cache backend', exc_info=ex)
 
 atexit.register(_cache_cleanup)
@@ -0,0 +1,54 @@
+import stat
+import bisect
+import struct
+
+from array import array
+
+
+# struct fuse_dirent: ino, off, namelen, type; followed by the name
+_dirent = struct.Struct('=QQII')
+
+
+class DirectoryListing:
+    '''A snapshot of a directory, packed as the kernel reads it
+
+    Entries are packed once, as `struct fuse_dirent`.  The offset the kernel
+    passes back is the index of the next entry, so each chunk of a large
+    listing is a slice of the buffer.  As with any directory, entries added
+    or removed between chunks may be skipped or repeated.
+    '''
+    __slots__ = ('version', 'data', 'starts')
+
+    def __init__(self, version, entries):
+        self.version = version
+        # byte offset of each entry, and the end of the last
+        self.starts = array('Q', [0])
+
+        chunks = []
+        pos = 0
+        for index, (name, attr) in enumerate(entries, 1):
+            name = name.encode('utf-8', 'surrogateescape')
+            chunk = (_dirent.pack(attr['st_ino'], index, len(name),
+                                  stat.S_IFMT(attr['st_mode']) >> 12) + name)
+            chunk += b'\0' * (-len(chunk) % 8)
+            chunks.append(chunk)
+            pos += len(chunk)
+            self.starts.append(pos)
+
+        self.data = b''.join(chunks)
+
+    def __len__(self):
+        return len(self.starts) - 1
+
+    @property
+    def nbytes(self):
+        return len(self.data) + self.starts.itemsize * len(self.starts)
+
+    def read(self, off, size):
+        '''Packed entries from index `off` that fit in `size` bytes'''
+        if off >= len(self):
+            return b''
+
+        start = self.starts[off]
+        end = bisect.bisect_right(self.starts, start + size, off) - 1
+        return self.data[start:self.starts[end]]
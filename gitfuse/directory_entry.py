@@ -1,126 +1,218 @@
-import os
 import time
-
 import stat
-from .util import EntryInfo
+import itertools
+import threading
+
+from .util import Inode, GeneratedInode
+
+
+# versions of directory contents, unique across directories
+_versions = itertools.count()
+
 
+class ReadableBytes:
+    '''File contents held in memory
+
+    The contents are copied once into a writable buffer, which lets reads
+    hand libfuse a pointer to a slice of it rather than a copy.
+    '''
+    __slots__ = ('data', )
+
+    def __init__(self, data):
+        self.data = memoryview(bytearray(data))
+
+    def __len__(self):
+        return len(self.data)
 
-class ReadableString(str):
     def read(self, size, offset):
-        return self.encode('utf-8')[offset:offset + size]
+        return self.data[offset:offset + size]
+
+
+class GeneratedFile:
+    '''File contents returned by `func`, generated again on each open
+
+    Each open file handle reads from a snapshot of its own.  The size is
+    that of the latest snapshot.
+    '''
+    __slots__ = ('func', 'size', 'mtime')
+
+    def __init__(self, func):
+        self.func = func
+        self.size = 0
+        self.mtime = time.time()
+
+    def __len__(self):
+        return self.size
+
+    def snapshot(self):
+        contents = ReadableBytes(self.func())
+        self.size = len(contents)
+        self.mtime = time.time()
+        return contents
+
+    def read(self, size, offset):
+        return self.snapshot().read(size, offset)
+
+
+class ReadableString(ReadableBytes):
+    '''Text file contents, encoded as UTF-8'''
+    __slots__ = ()
+
+    def __init__(self, text):
+        super().__init__(text.encode('utf-8'))
 
 
 class DirectoryEntry:
-    def __init__(self, fuse, parent_inode, *, file_attr=None, dir_attr=None,
-                 timestamp=None):
-        self.inode = fuse.create_ino()
+    # modes of the entries created in this directory
+    dir_mode = stat.S_IFDIR | 0o555
+    file_mode = stat.S_IFREG | 0o555
+    link_mode = stat.S_IFLNK | 0o777
+    # seconds the kernel may cache entries, or None for the fuse default
+    cache_timeout = None
+
+    def __init__(self, fuse, parent_inode, *, name='', timestamp=None):
+        self.inode = fuse.create_ino((parent_inode, name) if name else None)
         self.fuse = fuse
         self.parent_inode = parent_inode
         self.entry_by_name = {}
-        self.inodes = []
+        self.version = next(_versions)
+        # held while adding, removing or loading entries; lookups of a
+        # single name do not need it
+        self.lock = threading.RLock()
 
         if timestamp is None:
             timestamp = time.time()
 
-        if dir_attr is None:
-            dir_attr = dict(st_mode=stat.S_IFDIR | 0o555,
-                            st_nlink=2,
-                            st_uid=os.getuid(),
-                            st_gid=os.getgid(),
-                            # st_rdev=None,
-                            st_atime=timestamp,
-                            st_mtime=timestamp,
-                            st_ctime=timestamp,
-                            )
-
-        if file_attr is None:
-            file_attr = dict(st_mode=stat.S_IFREG | 0o555,
-                             st_nlink=1,
-                             st_uid=os.getuid(),
-                             st_gid=os.getgid(),
-                             # st_rdev=None,
-                             st_atime=timestamp,
-                             st_mtime=timestamp,
-                             st_ctime=timestamp,
-                             st_size=0,
-                             )
-        self.file_attr = file_attr
-        self.dir_attr = dir_attr
-        self.attr = dict(dir_attr, inode=self.inode,
-                         st_nlink=2)
-        self.entry = EntryInfo(type_='direntry', inode=self.inode,
-                               attr=self.attr, name='', obj=self)
-
+        self.entry = Inode(self.inode, self.dir_mode, parent=parent_inode,
+                           nlink=2, mtime=timestamp, name=name, obj=self)
         fuse.inode_entries[self.inode] = self.entry
 
     def __getitem__(self, name):
         return self.entry_by_name[name]
 
+    def ensure_loaded(self):
+        '''Start loading entries, if necessary
+
+        Returns None when the entries are available, or a
+        concurrent.futures.Future that completes when they are.
+        '''
+        return None
+
+    def unload(self):
+        '''Drop all entries, if they can be listed again on demand
+
+        Returns True if the entries were dropped.
+        '''
+        return False
+
+    def referenced_inodes(self):
+        '''Inodes below this directory that the kernel holds'''
+        lookup_counts = self.fuse.lookup_counts
+        for entry in list(self.entry_by_name.values()):
+            # the kernel holds the parent of everything it holds
+            if entry.inode in lookup_counts:
+                yield entry.inode
+                if entry.type_ == 'dir':
+                    yield from entry.obj.referenced_inodes()
+
+    def is_referenced(self):
+        '''Whether the kernel holds any inode below this directory'''
+        return any(True for ino in self.referenced_inodes())
+
+    def changed(self):
+        '''Note that entries or their attributes changed
+
+        Cached listings of the directory are rebuilt on next use.
+        '''
+        self.version = next(_versions)
+
     def get_entries(self):
-        entries = [('.', self.attr),
+        '''List (name, stat dict) with each entry's inode and mode'''
+        entries = [('.', dict(st_ino=self.inode, st_mode=self.entry.mode)),
                    ('..', dict(st_ino=self.parent_inode, st_mode=stat.S_IFDIR))
                    ]
 
-        for fn, info in self.entry_by_name.items():
-            entries.append((fn, info.attr))
+        # copied as the update thread may add entries while listing
+        with self.lock:
+            items = list(self.entry_by_name.items())
+
+        for fn, info in items:
+            entries.append((fn, dict(st_ino=info.inode, st_mode=info.mode)))
 
         return entries
 
+    def _add(self, entry):
+        with self.lock:
+            self.entry_by_name[entry.name] = entry
+            self.fuse.inode_entries[entry.inode] = entry
+            self.changed()
+        return entry
+
     def add_dir(self, dirname, *, dirobj=None):
         if dirobj is None:
-            dirobj = DirectoryEntry(self.fuse, self.inode,
-                                    file_attr=dict(self.file_attr),
-                                    dir_attr=dict(self.dir_attr),
-                                    )
-
-        attr = dirobj.attr
-        attr['st_ino'] = dirobj.inode
-        self.attr['st_nlink'] += 1
-
-        entry = EntryInfo(type_='dir', inode=dirobj.inode, attr=attr,
-                          name=dirname, obj=dirobj)
-        self.entry_by_name[dirname] = entry
-        self.fuse.inode_entries[dirobj.inode] = entry
-        return entry
+            dirobj = DirectoryEntry(self.fuse, self.inode, name=dirname,
+                                    timestamp=self.entry.mtime)
+
+        entry = dirobj.entry
+        entry.name = dirname
+        with self.lock:
+            self.entry.nlink += 1
+            return self._add(entry)
 
     def add_file(self, fn, *, obj=None, inode=None):
         if inode is None:
-            inode = self.fuse.create_ino()
+            inode = self.fuse.create_ino((self.inode, fn))
 
-        attr = dict(self.file_attr)
-        attr['st_ino'] = inode
-        attr['st_size'] = len(obj)
+        return self._add(Inode(inode, self.file_mode, parent=self.inode,
+                               size=len(obj), mtime=self.entry.mtime,
+                               name=fn, obj=obj))
 
-        entry = EntryInfo(type_='file', inode=inode, attr=attr, name=fn,
-                          obj=obj)
-        self.entry_by_name[fn] = entry
-        self.fuse.inode_entries[inode] = entry
-        return entry
+    def add_generated_file(self, fn, func):
+        '''Add a read-only file of the bytes returned by `func`
+
+        The contents are generated when the file is opened, and read with
+        direct I/O, as their size is only known then.
+        '''
+        inode = self.fuse.create_ino((self.inode, fn))
+        return self._add(GeneratedInode(inode, stat.S_IFREG | 0o444,
+                                        parent=self.inode, name=fn,
+                                        obj=GeneratedFile(func)))
 
     def add_link(self, fn, dest, *, obj=None, inode=None):
         if inode is None:
-            inode = self.fuse.create_ino()
-
-        attr = dict(self.file_attr)
-        attr['st_mode'] = (stat.S_IFLNK | 0o777)
-        attr['st_ino'] = inode
-        attr['st_size'] = len(dest) + 1
-        attr['st_nlink'] = 1
-
-        entry = EntryInfo(type_='link', inode=inode, attr=attr, name=fn,
-                          obj=ReadableString(dest))
-        self.entry_by_name[fn] = entry
-        self.fuse.inode_entries[inode] = entry
+            inode = self.fuse.create_ino((self.inode, fn))
+
+        if obj is None:
+            obj = ReadableString(dest)
+
+        # the target is read from obj, which may not be loaded yet
+        return self._add(Inode(inode, self.link_mode, parent=self.inode,
+                               size=len(obj), mtime=self.entry.mtime,
+                               name=fn, obj=obj))
+
+    def remove(self, name):
+        with self.lock:
+            entry = self.entry_by_name.pop(name)
+            self.fuse.inode_entries.pop(entry.inode, None)
+            self.changed()
+            if entry.type_ == 'dir':
+                self.entry.nlink -= 1
+
+        if entry.inode in self.fuse.lookup_counts:
+            self.fuse.invalidate_inode(entry.inode)
+            self.fuse.invalidate_entry(self.inode, name)
+        if entry.type_ == 'dir':
+            entry.obj.clear()
         return entry
 
-    def add_files(self, filenames):
-        inodes = self.fuse.create_ino_range(filenames)
-        return {fn: self.add_file(fn, inode=ino)
-                for ino, fn in zip(filenames, inodes)
-                }
-
-    def get_attr(self, inode):
-        return dict(self.file_attr, st_ino=inode)
+    def clear(self):
+        '''Remove all entries, and everything below them'''
+        with self.lock:
+            for name in list(self.entry_by_name):
+                self.remove(name)
 
-    def get_dir_attr(self, inode):
-        return dict(self.dir_attr, st_ino=inode)
+    def add_files(self, files):
+        '''Add files, given as (name, obj) pairs'''
+        return {fn: self.add_file(fn, obj=obj)
+                for fn, obj in files
+                }
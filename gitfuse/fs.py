@@ -2,96 +2,572 @@ import os
 import sys
 import signal
 import threading
+import json
+import time
 import errno
 import stat
+import ctypes
+import hashlib
+import logging
+import functools
+import itertools
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import fusell
 from fusell import FUSELL
 from .directory_entry import (DirectoryEntry, ReadableString)
+from .dirbuf import DirectoryListing
+from . import stats
+from .stats import instrument
+
+
+logger = logging.getLogger(__name__)
+
+
+# struct fuse_lowlevel_ops of libfuse 2.9, in order, up to forget_multi
+_lowlevel_ops = (
+    'init', 'destroy', 'lookup', 'forget', 'getattr', 'setattr', 'readlink',
+    'mknod', 'mkdir', 'unlink', 'rmdir', 'symlink', 'rename', 'link', 'open',
+    'read', 'write', 'flush', 'release', 'fsync', 'opendir', 'readdir',
+    'releasedir', 'fsyncdir', 'statfs', 'setxattr', 'getxattr', 'listxattr',
+    'removexattr', 'access', 'create', 'getlk', 'setlk', 'bmap', 'ioctl',
+    'poll', 'write_buf', 'retrieve_reply', 'forget_multi',
+)
+
+
+class fuse_forget_data(ctypes.Structure):
+    _fields_ = [('ino', ctypes.c_ulong), ('nlookup', ctypes.c_uint64)]
+
+
+def _register_forget_multi():
+    '''Add forget_multi to the operations FUSELL registers with libfuse
+
+    FUSELL's operations table stops short of it, so the kernel's batched
+    forgets would otherwise never reach the filesystem.  Operations between
+    the end of the table and forget_multi are left unregistered.
+    '''
+    ops = getattr(fusell, 'fuse_lowlevel_ops', None)
+    if ops is None:
+        return
+
+    names = tuple(name for name, _ in ops._fields_)
+    if names != _lowlevel_ops[:len(names)] or 'forget_multi' in names:
+        return
+
+    fields = list(ops._fields_)
+    for name in _lowlevel_ops[len(names):-1]:
+        fields.append((name, ctypes.c_void_p))
+    fields.append(('forget_multi',
+                   ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_size_t,
+                                    ctypes.POINTER(fuse_forget_data))))
+    fusell.fuse_lowlevel_ops = type('fuse_lowlevel_ops', (ctypes.Structure, ),
+                                    dict(_fields_=fields))
+
+
+_register_forget_multi()
+
+
+def _file_info(fi):
+    '''A fuse_file_info, given the pointer or dictionary FUSELL passes'''
+    if isinstance(fi, dict):
+        return fusell.fuse_file_info(**fi)
+    return fi.contents
+
+
+def dispatched(func):
+    '''Run a FUSE callback on the filesystem's worker pool, if it has one
+
+    The session thread then goes back to reading requests instead of
+    waiting for this one, which replies from its worker.  Arguments that
+    point into libfuse's buffers (`fi`) are only valid during the callback,
+    so dispatched callbacks must not use them.
+    '''
+    @functools.wraps(func)
+    def wrapped(self, req, *args):
+        if self._workers is None:
+            return func(self, req, *args)
+        self._workers.submit(self._run_request, func, req, args)
+    return wrapped
 
 
 class FileSystem(FUSELL):
-    def __init__(self, *args, **kwargs):
+    # seconds the kernel may cache attributes and names (including missing
+    # ones), unless a directory sets its own cache_timeout
+    cache_timeout = 1.0
+    # the FUSE channel, once mounted
+    channel = None
+    # memory for packed directory listings, most recently read kept
+    max_listing_bytes = 64 << 20
+
+    def __init__(self, *args, mount=True, workers=0, **kwargs):
+        # Concurrency: with `workers`, lookups, attributes, listings and
+        # reads are served by a pool of threads while the update thread and
+        # event loop modify the tree.  Each directory's lock guards its
+        # entries and loading; `lock` guards inode allocation, lookup counts
+        # and packed listings.  Single reads and writes of dictionaries and
+        # attributes are otherwise left to the GIL.
         self.lock = threading.RLock()
-        super().__init__(*args, **kwargs)
+        self._workers = (ThreadPoolExecutor(max_workers=workers)
+                         if workers else None)
+        # request -> (OperationStats, start time), until replied to
+        self._pending = {}
+        # file handle -> contents snapshotted when the file was opened
+        self._handles = {}
+        self._file_handles = itertools.count(1)
+        # cache invalidations are sent from their own thread: the kernel may
+        # hold a directory lock while waiting for a reply to a lookup there
+        self._notifier = ThreadPoolExecutor(max_workers=1)
+        if mount:
+            super().__init__(*args, **kwargs)
+        else:
+            # the tree is built as usual, but nothing talks to the kernel
+            # (e.g., for benchmarks)
+            self.init(None, None)
 
-    def create_ino(self):
-        with self.lock:
-            self.ino += 1
-            return self.ino
+    @property
+    def libfuse(self):
+        return self._libfuse
+
+    @libfuse.setter
+    def libfuse(self, libfuse):
+        self._libfuse = libfuse
+        try:
+            fuse_mount = libfuse.fuse_mount
+            libfuse.fuse_lowlevel_notify_inval_entry.argtypes = (
+                ctypes.c_void_p, ctypes.c_uint64, ctypes.c_char_p,
+                ctypes.c_size_t)
+            libfuse.fuse_lowlevel_notify_inval_inode.argtypes = (
+                ctypes.c_void_p, ctypes.c_uint64, ctypes.c_int64,
+                ctypes.c_int64)
+        except AttributeError:
+            logger.warning('libfuse does not support cache invalidation')
+            return
+
+        # the channel is needed for notifications, but is not kept by FUSELL
+        def mount(*args):
+            self.channel = fuse_mount(*args)
+            return self.channel
+
+        libfuse.fuse_mount = mount
+
+    def create_ino(self, key=None):
+        '''An inode number for `key`, a (parent inode, name) pair
+
+        Numbers are a 64-bit hash of the key, so that an entry keeps its
+        inode across evictions and remounts; as the parent inode is part of
+        the key, the number follows from the entry's full path.  Entries
+        without a key are numbered sequentially, below 2**32, where hashed
+        numbers never fall.
+        '''
+        if key is None:
+            with self.lock:
+                self.ino += 1
+                return self.ino
+
+        parent_inode, name = key
+        for attempt in itertools.count():
+            digest = hashlib.blake2b(
+                '{}/{}/{}'.format(parent_inode, name, attempt)
+                .encode('utf-8', 'surrogateescape'), digest_size=8).digest()
+            ino = int.from_bytes(digest, 'little')
+            if ino <= 0xffffffff:
+                continue
+
+            entry = self.inode_entries.get(ino, None)
+            if entry is None or (entry.parent, entry.name) == key:
+                return ino
+            logger.warning('Inode %d of %r collides with %r', ino, key,
+                           entry)
 
     def create_ino_range(self, num):
+        '''Sequential inode numbers for `num` entries without a key'''
         with self.lock:
             start_inode = self.ino + 1
-            self.ino = start_inode + num
+            self.ino += num
             return range(start_inode, self.ino + 1)
 
     def init(self, userdata, conn):
         self.ino = 0
         self.inode_entries = {}
+        # inode -> number of lookups not yet forgotten by the kernel
+        self.lookup_counts = {}
+        self.evicted_inodes = 0
+        # inode -> DirectoryListing, least recently read first
+        self._listings = OrderedDict()
+        self._listing_bytes = 0
         self.root = DirectoryEntry(self, parent_inode=1)
 
-    forget = None
+        stats_dir = self.root.add_dir('.gitfuse').obj
+        # regenerated on open with a new size, so the kernel must always ask
+        stats_dir.cache_timeout = 0.0
+        stats_dir.add_generated_file(
+            'stats', lambda: json.dumps(self.get_statistics(), indent=1,
+                                        sort_keys=True).encode('utf-8'))
+        stats_dir.add_generated_file(
+            'stats.prom',
+            lambda: stats.to_prometheus(self.get_statistics()).encode('utf-8'))
+
+    def get_statistics(self):
+        '''Statistics for /.gitfuse/stats'''
+        return dict(operations=stats.get_statistics(),
+                    inodes=dict(total=len(self.inode_entries),
+                                referenced=len(self.lookup_counts),
+                                evicted=self.evicted_inodes),
+                    listings=dict(cached=len(self._listings),
+                                  bytes=self._listing_bytes),
+                    pending_requests=len(self._pending),
+                    open_snapshots=len(self._handles),
+                    )
+
+    def _replied(self, req, error=False):
+        try:
+            op, t0 = self._pending.pop(req)
+        except KeyError:
+            return
+        op.observe(time.perf_counter() - t0, error)
+
+    def reply_err(self, req, err):
+        self._replied(req, error=(err != 0))
+        return super().reply_err(req, err)
+
+    def reply_entry(self, req, entry):
+        self._replied(req)
+        return super().reply_entry(req, entry)
+
+    def reply_attr(self, req, attr, attr_timeout):
+        self._replied(req)
+        return super().reply_attr(req, attr, attr_timeout)
+
+    def reply_readlink(self, req, link):
+        self._replied(req)
+        return super().reply_readlink(req, link)
+
+    def destroy(self, userdata):
+        # notifications still queued are dropped once unmounted
+        self.channel = None
+        self._notifier.shutdown(wait=False)
+        if self._workers is not None:
+            self._workers.shutdown(wait=False)
+
+    def _run_request(self, func, req, args):
+        try:
+            func(self, req, *args)
+        except Exception:
+            logger.exception('%s failed', func.__name__)
+            self.reply_err(req, errno.EIO)
+
+    def _add_lookup(self, ino):
+        with self.lock:
+            self.lookup_counts[ino] = self.lookup_counts.get(ino, 0) + 1
+
+    def _forget(self, ino, nlookup):
+        with self.lock:
+            count = self.lookup_counts.get(ino, 0) - nlookup
+            if count > 0:
+                self.lookup_counts[ino] = count
+                return
+            self.lookup_counts.pop(ino, None)
+
+        # the kernel no longer caches anything below a forgotten directory,
+        # so lazily listed entries can be dropped until they are next used
+        entry = self.inode_entries.get(ino, None)
+        if entry is not None and entry.type_ == 'dir':
+            num_inodes = len(self.inode_entries)
+            if entry.obj.unload():
+                evicted = num_inodes - len(self.inode_entries)
+                self.evicted_inodes += evicted
+                logger.debug('Evicted %d inodes below %r', evicted,
+                             entry.name)
+
+    def forget(self, req, ino, nlookup):
+        self._forget(ino, nlookup)
+        self.reply_none(req)
+
+    def fuse_forget_multi(self, req, count, forgets):
+        # libfuse passes an array of struct fuse_forget_data
+        self.forget_multi(req, [(forgets[i].ino, forgets[i].nlookup)
+                                for i in range(count)])
+
+    def forget_multi(self, req, forgets):
+        '''Forget a batch of inodes, given as (ino, nlookup) pairs'''
+        for ino, nlookup in forgets:
+            self._forget(ino, nlookup)
+        self.reply_none(req)
+
+    def _when_loaded(self, req, obj, callback):
+        '''Call `callback` once the entries of `obj` are available
+
+        Directories backed by remote data return a concurrent future from
+        `ensure_loaded` while they are being fetched.  In that case the
+        reply is sent from the future's completion callback rather than
+        blocking the FUSE session thread.
+        '''
+        ensure_loaded = getattr(obj, 'ensure_loaded', None)
+        fut = (ensure_loaded() if ensure_loaded is not None else None)
+        if fut is None:
+            callback()
+            return
+
+        def loaded(fut):
+            if fut.cancelled() or fut.exception() is not None:
+                logger.error('Failed to load %r', obj,
+                             exc_info=(None if fut.cancelled()
+                                       else fut.exception()))
+                self.reply_err(req, errno.EIO)
+            else:
+                callback()
 
+        fut.add_done_callback(loaded)
+
+    def get_cache_timeout(self, parent_inode):
+        '''Seconds the kernel may cache the entries of a directory'''
+        try:
+            timeout = self.inode_entries[parent_inode].obj.cache_timeout
+        except (KeyError, AttributeError):
+            timeout = None
+        return self.cache_timeout if timeout is None else timeout
+
+    def invalidate_entry(self, parent_inode, name):
+        '''Have the kernel drop its lookup of `name`, and anything below it'''
+        # nothing is cached below directories the kernel does not hold
+        if parent_inode == 1 or parent_inode in self.lookup_counts:
+            self._notifier.submit(self._notify_inval_entry, parent_inode,
+                                  name)
+
+    def invalidate_inode(self, ino):
+        '''Have the kernel drop its cached attributes and data of `ino`'''
+        if ino in self.lookup_counts:
+            self._notifier.submit(self._notify_inval_inode, ino)
+
+    def _notify_inval_entry(self, parent_inode, name):
+        if self.channel is None:
+            return
+
+        name = name.encode('utf-8', 'surrogateescape')
+        err = self.libfuse.fuse_lowlevel_notify_inval_entry(
+            self.channel, parent_inode, name, len(name))
+        if err not in (0, -errno.ENOENT):
+            logger.debug('Invalidation of %d/%r failed: %d', parent_inode,
+                         name, err)
+
+    def _notify_inval_inode(self, ino):
+        if self.channel is None:
+            return
+
+        err = self.libfuse.fuse_lowlevel_notify_inval_inode(self.channel,
+                                                            ino, 0, 0)
+        if err not in (0, -errno.ENOENT):
+            logger.debug('Invalidation of inode %d failed: %d', ino, err)
+
+    @instrument('getattr')
+    @dispatched
     def getattr(self, req, ino, fi):
         try:
             entry = self.inode_entries[ino]
         except KeyError:
             self.reply_err(req, errno.ENOENT)
         else:
-            self.reply_attr(req, entry.attr, 1.0)
+            self.reply_attr(req, entry.stat(),
+                            self.get_cache_timeout(entry.parent))
 
+    @instrument('lookup')
+    @dispatched
     def lookup(self, req, parent_inode, name):
-        parent = self.inode_entries[parent_inode].obj
+        try:
+            parent = self.inode_entries[parent_inode].obj
+        except KeyError:
+            self.reply_err(req, errno.ENOENT)
+            return
+
         name = name.decode('utf-8')
+        self._when_loaded(req, parent,
+                          functools.partial(self._reply_lookup, req, parent,
+                                            name))
 
+    def _reply_lookup(self, req, parent, name):
         try:
             entry = parent[name]
-        except (KeyError, TypeError):
+        except TypeError:
             self.reply_err(req, errno.ENOENT)
+        except KeyError:
+            # a negative entry, which the kernel caches like any other
+            timeout = self.get_cache_timeout(parent.inode)
+            self.reply_entry(req, dict(ino=0, attr=dict(st_ino=0),
+                                       attr_timeout=timeout,
+                                       entry_timeout=timeout))
         else:
+            self._add_lookup(entry.inode)
+            timeout = self.get_cache_timeout(entry.parent)
             entry = dict(ino=entry.inode,
-                         attr=entry.attr,
-                         attr_timeout=1.0,
-                         entry_timeout=1.0)
+                         attr=entry.stat(),
+                         attr_timeout=timeout,
+                         entry_timeout=timeout)
             self.reply_entry(req, entry)
 
+    @instrument('readdir')
+    @dispatched
     def readdir(self, req, ino, size, off, fi):
-        tree = self.inode_entries[ino].obj
-        entries = tree.get_entries()
-        self.reply_readdir(req, size, off, entries)
+        try:
+            tree = self.inode_entries[ino].obj
+        except KeyError:
+            self.reply_err(req, errno.ENOENT)
+            return
+
+        self._when_loaded(req, tree,
+                          functools.partial(self._reply_readdir, req, tree,
+                                            size, off))
+
+    def get_listing(self, tree):
+        '''The packed listing of a directory, rebuilt only if it changed'''
+        key = tree.inode
+        version = tree.version
+        with self.lock:
+            listing = self._listings.get(key, None)
+            if listing is not None and listing.version == version:
+                self._listings.move_to_end(key)
+                return listing
 
+        listing = DirectoryListing(version, tree.get_entries())
+        with self.lock:
+            old = self._listings.pop(key, None)
+            if old is not None:
+                self._listing_bytes -= old.nbytes
+            self._listings[key] = listing
+            self._listing_bytes += listing.nbytes
+            while (self._listing_bytes > self.max_listing_bytes and
+                   len(self._listings) > 1):
+                _, old = self._listings.popitem(last=False)
+                self._listing_bytes -= old.nbytes
+        return listing
+
+    def _reply_readdir(self, req, tree, size, off):
+        try:
+            listing = self.get_listing(tree)
+        except AttributeError:
+            self.reply_err(req, errno.ENOTDIR)
+            return
+
+        self.reply_buf(req, listing.read(off, size))
+
+    @instrument('open')
+    def open(self, req, ino, fi):
+        info = _file_info(fi)
+        entry = self.inode_entries.get(ino, None)
+        snapshot = getattr(getattr(entry, 'obj', None), 'snapshot', None)
+        if snapshot is not None:
+            # generated files are read from a snapshot of their own, and
+            # directly, as the size the kernel saw at stat may be stale
+            try:
+                contents = snapshot()
+            except Exception:
+                logger.exception('Failed to generate %r', entry.name)
+                self.reply_err(req, errno.EIO)
+                return
+
+            info.fh = next(self._file_handles)
+            info.direct_io = 1
+            self._handles[info.fh] = contents
+
+        self._replied(req)
+        self.libfuse.fuse_reply_open(req, ctypes.byref(info))
+
+    def release(self, req, ino, fi):
+        self._handles.pop(_file_info(fi).fh, None)
+        self.reply_err(req, 0)
+
+    @instrument('read')
     def read(self, req, ino, size, offset, fi):
-        print('read:', ino, size, offset)
+        # fi is only valid during the callback, so take its handle now
+        self._read(req, ino, size, offset, _file_info(fi).fh if fi else 0)
+
+    @dispatched
+    def _read(self, req, ino, size, offset, fh):
+        logger.debug('read: %d %d %d', ino, size, offset)
+        contents = self._handles.get(fh, None) if fh else None
+        if contents is not None:
+            self._reply_read(req, contents, size, offset)
+            return
+
         try:
             obj = self.inode_entries[ino].obj
         except (KeyError, AttributeError):
             self.reply_err(req, errno.EIO)
         else:
-            try:
-                if obj is None:
-                    buf = b''
-                else:
-                    buf = obj.read(size, offset)
-            except Exception:
+            self._when_loaded(req, obj,
+                              functools.partial(self._reply_read, req, obj,
+                                                size, offset))
+
+    def _reply_read(self, req, obj, size, offset, retry=True):
+        try:
+            if obj is None:
+                buf = b''
+            else:
+                buf = obj.read(size, offset)
+        except KeyError:
+            if retry:
+                # evicted from its store since it was loaded; load it again
+                self._when_loaded(req, obj,
+                                  functools.partial(self._reply_read, req,
+                                                    obj, size, offset,
+                                                    retry=False))
+            else:
                 self.reply_err(req, errno.EIO)
-                return
+            return
+        except Exception:
+            self.reply_err(req, errno.EIO)
+            return
 
-            self.reply_buf(req, buf)
+        self.reply_buf(req, buf)
 
+    def reply_buf(self, req, buf):
+        self._replied(req)
+        if isinstance(buf, memoryview):
+            if buf.readonly or not len(buf):
+                buf = bytes(buf)
+            else:
+                # pass libfuse a pointer into the buffer (e.g., a memory
+                # mapped file) instead of copying it into a bytes object
+                cbuf = (ctypes.c_char * len(buf)).from_buffer(buf)
+                return self.libfuse.fuse_reply_buf(
+                    req, ctypes.cast(cbuf, ctypes.c_char_p), len(buf))
+
+        return super().reply_buf(req, buf)
+
+    @instrument('readlink')
+    @dispatched
     def readlink(self, req, ino):
-        print('readlink', req, ino)
+        logger.debug('readlink: %d', ino)
         try:
             entry = self.inode_entries[ino]
         except (KeyError, AttributeError):
             self.reply_err(req, errno.ENOENT)
         else:
-            attr = entry.attr
-            if (attr['st_mode'] & stat.S_IFLNK) == stat.S_IFLNK:
-                reply = entry.obj.read(2048, 0)
-                self.reply_readlink(req, reply)
+            if stat.S_ISLNK(entry.mode):
+                self._when_loaded(req, entry.obj,
+                                  functools.partial(self._reply_readlink, req,
+                                                    entry.obj))
             else:
                 self.reply_err(req, errno.ENOENT)
 
+    def _reply_readlink(self, req, obj, retry=True):
+        try:
+            target = bytes(obj.read(len(obj), 0))
+        except KeyError:
+            if retry:
+                self._when_loaded(req, obj,
+                                  functools.partial(self._reply_readlink, req,
+                                                    obj, retry=False))
+            else:
+                self.reply_err(req, errno.EIO)
+            return
+        except Exception:
+            self.reply_err(req, errno.EIO)
+            return
+
+        self.reply_readlink(req, target)
+
     # def mkdir(self, req, parent, name, mode):
     #     print('mkdir:', parent, name)
     #     ino = self.create_ino()
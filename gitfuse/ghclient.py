@@ -1,15 +1,56 @@
 import os
+import re
 import time
+import base64
+import heapq
 import asyncio
 import logging
+import functools
+import itertools
+import collections
+import urllib.parse
 
 import aiohttp
 
 from .cache import caches
 
 access_token = os.environ.get('OAUTH_TOKEN', None)
+api_url = os.environ.get('GITHUB_API_URL', 'https://api.github.com')
+# The GraphQL API is only available to authenticated clients
+use_graphql = (access_token is not None)
 logger = logging.getLogger(__name__)
 
+per_page = 100
+
+# Request priorities, lowest value first
+INTERACTIVE = 0
+BACKGROUND = 1
+
+# Running totals of 'requests', 'not_modified', 'graphql' and 'deduplicated'
+counters = collections.Counter()
+
+_link_re = re.compile(r'\s*<([^>]*)>\s*;\s*rel="([^"]*)"')
+
+
+def parse_link_header(value):
+    '''Parse an RFC 5988 Link header into a dictionary of {rel: url}'''
+    links = {}
+    if value:
+        for part in value.split(','):
+            match = _link_re.match(part)
+            if match is not None:
+                url, rel = match.groups()
+                links[rel] = url
+    return links
+
+
+def _page_from_url(url):
+    query = urllib.parse.parse_qs(urllib.parse.urlparse(url).query)
+    try:
+        return int(query['page'][0])
+    except (KeyError, IndexError, ValueError):
+        return None
+
 
 class GitResponse:
     def __init__(self, response, json):
@@ -17,46 +58,246 @@ class GitResponse:
         self.json = json
 
         headers = response.headers
-        self.timestamp = headers['DATE']
+        self.timestamp = headers.get('DATE', None)
         self.etag = headers.get('ETAG', None)
-        self.rate_limit_remaining = int(headers['X-RATELIMIT-REMAINING'])
+        self.last_modified = headers.get('LAST-MODIFIED', None)
+        self.rate_limit = int(headers.get('X-RATELIMIT-LIMIT', 0)) or None
+        # None if not reported (e.g., by a proxy in front of the API)
+        self.rate_limit_remaining = (
+            int(headers['X-RATELIMIT-REMAINING'])
+            if 'X-RATELIMIT-REMAINING' in headers else None)
+        self.rate_limit_reset = int(headers.get('X-RATELIMIT-RESET', 0))
+        # the quota counted against: 'core' for REST, 'graphql', etc.
+        self.rate_limit_resource = headers.get('X-RATELIMIT-RESOURCE', None)
         self.unmodified = (response.status == 304)
-        if (self.rate_limit_remaining % 100) == 0:
+        self.links = parse_link_header(headers.get('LINK', None))
+        # seconds to wait between polls of the events API
+        self.poll_interval = int(headers.get('X-POLL-INTERVAL', 0)) or None
+        if (self.rate_limit_remaining or 0) % 100 == 0:
             logger.debug('Rate limit remaining: %s', self.rate_limit_remaining)
 
     @property
     def headers(self):
         return self.response.headers
 
+    @property
+    def rate_limited(self):
+        return (self.response.status in (403, 429) and
+                self.rate_limit_remaining == 0)
+
+    @property
+    def next_page(self):
+        if 'next' in self.links:
+            return _page_from_url(self.links['next'])
+
+    @property
+    def last_page(self):
+        if 'last' in self.links:
+            return _page_from_url(self.links['last'])
+
+
+class RequestScheduler:
+    '''Limits concurrent GitHub requests and paces them by the rate limit
+
+    At most `max_concurrency` requests are in flight at once; when a slot
+    frees up, waiting INTERACTIVE requests are always served before
+    BACKGROUND ones.  Once the remaining quota falls to the background
+    reserve, background requests are deferred until the rate limit window
+    resets so that the rest of it is left for interactive lookups.  The
+    reserve is `reserve_fraction` of the limit (10% of 5000/h when
+    authenticated, of 60/h when not), but no more than `background_reserve`.
+    With no quota left, all requests wait for the reset.  Only the REST
+    ('core') quota is tracked; GraphQL is counted separately by GitHub.
+    '''
+    def __init__(self, max_concurrency=8, background_reserve=500,
+                 reserve_fraction=0.1):
+        self.max_concurrency = max_concurrency
+        self.background_reserve = background_reserve
+        self.reserve_fraction = reserve_fraction
+        self.rate_limit = None
+        self.rate_limit_remaining = None
+        self.rate_limit_reset = None
+        self.active = 0
+        self._waiting = []
+        self._counter = itertools.count()
+
+    def quota_delay(self, priority):
+        '''Seconds a request of `priority` should wait for the quota reset'''
+        if self.rate_limit_remaining is None or self.rate_limit_reset is None:
+            return 0.0
+
+        delay = self.rate_limit_reset - time.time()
+        if delay <= 0:
+            # a new window has started; the next response will tell us more
+            self.rate_limit_remaining = None
+            return 0.0
+
+        floor = (self.reserve if priority == BACKGROUND else 0)
+        if self.rate_limit_remaining > floor:
+            return 0.0
+        return delay
+
+    @property
+    def reserve(self):
+        '''Requests of each window left for INTERACTIVE ones only'''
+        if self.rate_limit is None:
+            return self.background_reserve
+        return min(int(self.rate_limit * self.reserve_fraction),
+                   self.background_reserve)
+
+    async def acquire(self, priority=BACKGROUND):
+        while True:
+            delay = self.quota_delay(priority)
+            if delay > 0:
+                logger.info('Rate limit low (%s remaining); deferring '
+                            'request for %.0f seconds',
+                            self.rate_limit_remaining, delay)
+                # poll again at least every minute in case a response from
+                # another request shows the window has been reset
+                await asyncio.sleep(min(delay, 60.0))
+                continue
+
+            if self.active < self.max_concurrency and not self._waiting:
+                self.active += 1
+            else:
+                fut = asyncio.get_event_loop().create_future()
+                heapq.heappush(self._waiting,
+                               (priority, next(self._counter), fut))
+                try:
+                    await fut
+                except asyncio.CancelledError:
+                    if fut.done() and not fut.cancelled():
+                        self.release()
+                    raise
+
+            if self.quota_delay(priority) <= 0:
+                return
+
+            # the quota ran low while waiting for a slot
+            self.release()
+
+    def release(self):
+        while self._waiting:
+            _, _, fut = heapq.heappop(self._waiting)
+            if not fut.done():
+                # hand the slot over directly to the next waiter
+                fut.set_result(None)
+                return
+
+        self.active -= 1
+
+    def update_rate_limit(self, resp):
+        if resp.rate_limit_remaining is None:
+            return
+        elif resp.rate_limit_resource not in (None, 'core'):
+            # e.g., GraphQL, whose points are a separate quota
+            logger.debug('%s rate limit remaining: %s',
+                         resp.rate_limit_resource, resp.rate_limit_remaining)
+            return
+
+        if resp.rate_limit:
+            self.rate_limit = resp.rate_limit
+        self.rate_limit_remaining = resp.rate_limit_remaining
+        if resp.rate_limit_reset:
+            self.rate_limit_reset = resp.rate_limit_reset
+        elif resp.rate_limited:
+            self.rate_limit_reset = time.time() + 60.0
+
+
+scheduler = RequestScheduler()
+
+
+class SingleFlight:
+    '''Shares one in-flight call between concurrent callers with the same key
+
+    The first caller for a key starts the call; callers arriving while it is
+    running await the same result instead of starting their own.  A
+    BACKGROUND call may be held back by the scheduler until the rate limit
+    resets, so INTERACTIVE callers never join one: they start their own
+    call, which later callers of either priority then share.
+    '''
+    def __init__(self):
+        # key -> (future, priority)
+        self._inflight = {}
+
+    def __len__(self):
+        return len(self._inflight)
+
+    def _done(self, key, fut):
+        if self._inflight.get(key, (None, None))[0] is fut:
+            del self._inflight[key]
+
+    async def run(self, key, coro_func, priority=BACKGROUND):
+        fut, fut_priority = self._inflight.get(key, (None, None))
+        if fut is None or fut_priority > priority:
+            fut = asyncio.ensure_future(coro_func())
+            self._inflight[key] = (fut, priority)
+            fut.add_done_callback(functools.partial(self._done, key))
+        else:
+            counters['deduplicated'] += 1
+            logger.debug('Joining in-flight request for %s', key)
+
+        # one caller being cancelled should not cancel the others
+        return await asyncio.shield(fut)
+
+
+single_flight = SingleFlight()
+
 
 class CachedResponse:
+    unmodified = True
+    links = {}
+    next_page = None
+    last_page = None
+
     def __init__(self, timestamp, json):
         self.timestamp = timestamp
         self.json = json
 
 
-def make_session():
-    params = {}
+class ResponseError(Exception):
+    def __init__(self, url, resp):
+        self.url = url
+        self.status = resp.response.status
+        try:
+            message = resp.json['message']
+        except (KeyError, TypeError):
+            message = ''
+        super().__init__('{} returned {}: {}'.format(url, self.status,
+                                                     message))
+
+
+def make_session(*, connection_limit=100, limit_per_host=20,
+                 dns_cache_ttl=300, keepalive_timeout=60.0):
+    '''Create a pooled ClientSession for GitHub API requests
+
+    Connections are kept alive and reused between requests, at most
+    `limit_per_host` of them to a single host, and DNS lookups are cached for
+    `dns_cache_ttl` seconds.  Proxy settings are taken from the environment
+    (http_proxy/https_proxy).  The caller owns the session and is responsible
+    for closing it.
+    '''
+    headers = {}
     if access_token is not None:
-        params['access_token'] = access_token
-
-    system_proxy = os.environ.get('http_proxy', None)
-    if system_proxy is not None:
-        conn = aiohttp.ProxyConnector(proxy=system_proxy)
-        return aiohttp.ClientSession(connector=conn), params
+        headers['Authorization'] = 'token {}'.format(access_token)
 
-    return aiohttp.ClientSession(), params
+    conn = aiohttp.TCPConnector(limit=connection_limit,
+                                limit_per_host=limit_per_host,
+                                ttl_dns_cache=dns_cache_ttl,
+                                keepalive_timeout=keepalive_timeout)
+    return aiohttp.ClientSession(connector=conn, headers=headers,
+                                 trust_env=True)
 
 
 async def _get_json_response(url, *, user_params=None, session=None,
-                             user_headers=None, etag=None):
+                             user_headers=None, etag=None,
+                             last_modified=None, priority=BACKGROUND):
     params = {}
     headers = {}
 
     if session is None:
-        session, session_params = make_session()
+        session = make_session()
         own_session = True
-        params.update(session_params)
     else:
         own_session = False
 
@@ -69,91 +310,453 @@ async def _get_json_response(url, *, user_params=None, session=None,
     if etag is not None:
         headers['If-None-Match'] = etag
 
+    if last_modified is not None:
+        headers['If-Modified-Since'] = last_modified
+
     try:
-        async with session.get('https://api.github.com/{}'.format(url),
-                               params=params, headers=headers) as resp:
-            if etag is not None and resp.status == 304:
-                json = {}
-            else:
-                json = await resp.json()
-    except Exception:
-        raise
+        while True:
+            await scheduler.acquire(priority)
+            try:
+                async with session.get('{}/{}'.format(api_url, url),
+                                       params=params, headers=headers) as resp:
+                    if resp.status == 304:
+                        json = {}
+                    else:
+                        json = await resp.json()
+            finally:
+                scheduler.release()
+
+            git_resp = GitResponse(resp, json)
+            counters['requests'] += 1
+            if git_resp.unmodified:
+                counters['not_modified'] += 1
+            scheduler.update_rate_limit(git_resp)
+            if not git_resp.rate_limited:
+                break
+
+            logger.warning('Rate limit exceeded requesting %s; retrying '
+                           'after reset', url)
     finally:
         if own_session:
-            session.close()
+            await session.close()
 
-    return GitResponse(resp, json)
+    return git_resp
 
 
-async def get_cacheable_response(key, url, cache):
-    resp = await _get_json_response(url, etag=cache.tags.get(key, None))
-    if not resp.unmodified:
-        cache.set_with_tag(key, tag=resp.etag, value=resp.json)
+class GraphQLError(Exception):
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        # 404 if something queried does not exist, as for a ResponseError
+        self.status = status
 
-    return resp, cache[key]
 
+async def _post_graphql(query, variables, *, session=None,
+                        priority=BACKGROUND):
+    if session is None:
+        session = make_session()
+        own_session = True
+    else:
+        own_session = False
 
-async def get_user_repos(user):
-    resp = await get_cacheable_response(user,
+    try:
+        await scheduler.acquire(priority)
+        try:
+            async with session.post('{}/graphql'.format(api_url),
+                                    json=dict(query=query,
+                                              variables=variables)) as resp:
+                try:
+                    json = await resp.json(content_type=None)
+                except ValueError:
+                    # e.g., an HTML error page from a proxy
+                    json = None
+        finally:
+            scheduler.release()
+    finally:
+        if own_session:
+            await session.close()
+
+    counters['graphql'] += 1
+    git_resp = GitResponse(resp, json)
+    scheduler.update_rate_limit(git_resp)
+    if resp.status != 200 or not isinstance(json, dict):
+        raise ResponseError('graphql', git_resp)
+
+    errors = json.get('errors')
+    if errors:
+        not_found = any(error.get('type') == 'NOT_FOUND' for error in errors)
+        raise GraphQLError('; '.join(error.get('message', str(error))
+                                     for error in errors),
+                           status=(404 if not_found else None))
+    return json['data']
+
+
+def _cache_tag(tag):
+    # tags from earlier versions were a bare ETag or fetch time
+    if isinstance(tag, dict):
+        return tag
+    elif isinstance(tag, str):
+        return dict(etag=tag, fetched=0.0)
+    elif isinstance(tag, (int, float)):
+        return dict(fetched=tag)
+    return dict(fetched=0.0)
+
+
+async def get_cached_response(key, url, cache, *, max_age=30.0, **kwargs):
+    '''Get a JSON response by way of `cache`
+
+    Within `max_age` seconds of it being fetched, the cached value is
+    returned without a request (with max_age=None, it never expires).  After
+    that the request is made conditional on the cached ETag or
+    Last-Modified, and a 304 response only renews the fetch time.  GitHub
+    does not count 304 responses against the rate limit.
+
+    Concurrent requests for the same entry share a single request.
+
+    Returns (response, value), where the response is a CachedResponse if no
+    request was made.
+    '''
+    try:
+        tag, value = cache.get_with_tag(key)
+    except KeyError:
+        pass
+    else:
+        tag = _cache_tag(tag)
+        if max_age is None or time.time() - tag['fetched'] < max_age:
+            return CachedResponse(tag['fetched'], value), value
+
+    # keyed on the cache entry, which identifies the URL and its parameters
+    # (or, for commits, the SHA shared by forks of a repository)
+    return await single_flight.run(
+        (cache.name, key),
+        functools.partial(_fetch_cached_response, key, url, cache, **kwargs),
+        priority=kwargs.get('priority', BACKGROUND))
+
+
+async def _fetch_cached_response(key, url, cache, **kwargs):
+    now = time.time()
+    try:
+        tag, value = cache.get_with_tag(key)
+    except KeyError:
+        tag, value = dict(fetched=0.0), None
+        cached = False
+    else:
+        tag = _cache_tag(tag)
+        cached = True
+
+    resp = await _get_json_response(
+        url, etag=(tag.get('etag', None) if cached else None),
+        last_modified=(tag.get('last_modified', None) if cached else None),
+        **kwargs)
+
+    if resp.unmodified and cached:
+        cache.set_tag(key, dict(tag, fetched=now))
+        return resp, value
+    elif resp.response.status != 200:
+        raise ResponseError(url, resp)
+
+    cache.set_with_tag(key, tag=dict(etag=resp.etag,
+                                     last_modified=resp.last_modified,
+                                     fetched=now),
+                       value=resp.json)
+    return resp, resp.json
+
+
+def _page_key(key, page):
+    return '{}?page={}'.format(key, page)
+
+
+async def _get_cacheable_page(key, url, cache, page, **kwargs):
+    return await get_cached_response(_page_key(key, page), url, cache,
+                                     user_params=dict(per_page=per_page,
+                                                      page=page),
+                                     **kwargs)
+
+
+async def get_paginated_response(key, url, cache, **kwargs):
+    '''Get all pages of a listing, each cached as by get_cached_response
+
+    Pages are stored individually in `cache` under '<key>?page=<n>'.  When
+    the number of pages is known from the first response's Link header (or,
+    if the first page was not modified, from the pages cached last time),
+    the remaining pages are requested concurrently; otherwise rel="next" is
+    followed.  rel="next" of the last of those pages is followed too, until
+    a page has no rel="next" or fewer than `per_page` items.
+
+    Returns the response for the first page and the concatenated items.
+    '''
+    first_resp, items = await _get_cacheable_page(key, url, cache, 1,
+                                                  **kwargs)
+    items = list(items)
+
+    last_page = first_resp.last_page
+    if last_page is None and first_resp.unmodified and not first_resp.links:
+        last_page = 1
+        while _page_key(key, last_page + 1) in cache:
+            last_page += 1
+
+    if last_page is not None:
+        pages = await asyncio.gather(*(_get_cacheable_page(key, url, cache,
+                                                           page, **kwargs)
+                                       for page in range(2, last_page + 1)))
+        for _, page_items in pages:
+            items.extend(page_items)
+
+        resp, page_items = (pages[-1] if pages else (first_resp, items))
+    else:
+        last_page = 1
+        resp, page_items = first_resp, items
+
+    # a page that grew past the pages counted above links to the next one
+    while resp.next_page is not None and len(page_items) >= per_page:
+        last_page = resp.next_page
+        resp, page_items = await _get_cacheable_page(key, url, cache,
+                                                     last_page, **kwargs)
+        items.extend(page_items)
+
+    # the listing may have shrunk since the last time it was fetched
+    page = last_page + 1
+    while _page_key(key, page) in cache:
+        cache.discard(_page_key(key, page))
+        page += 1
+
+    return first_resp, items
+
+
+def expire_paginated(key, cache):
+    '''Have the next get_paginated_response of `key` revalidate every page
+
+    The pages stay cached, so the requests are still conditional.
+    '''
+    page = 1
+    while True:
+        page_key = _page_key(key, page)
+        try:
+            tag, _ = cache.get_with_tag(page_key)
+        except KeyError:
+            return
+        cache.set_tag(page_key, dict(_cache_tag(tag), fetched=0.0))
+        page += 1
+
+
+async def get_user_repos(user, **kwargs):
+    resp = await get_paginated_response(user,
                                         'users/{}/repos'.format(user),
-                                        cache=caches['user-repo'])
+                                        cache=caches['user-repo'], **kwargs)
     return resp
 
 
-async def get_org_repos(org):
-    resp = await get_cacheable_response(org,
+async def get_org_repos(org, **kwargs):
+    resp = await get_paginated_response(org,
                                         'orgs/{}/repos'.format(org),
-                                        cache=caches['org-repo'])
+                                        cache=caches['org-repo'], **kwargs)
     return resp
 
 
-async def get_if_newer_than_cache(url, cache, *, max_age=60 * 10, key=None):
-    if key is None:
-        key = url
+def expire_repos(owner, *, org=False):
+    expire_paginated(owner, caches['org-repo' if org else 'user-repo'])
 
-    t0 = time.time()
-    cached_time = cache.tags.get(key, 0.0)
-    cache_age = t0 - cached_time
-    if cache_age < max_age:
-        resp = CachedResponse(cache.tags[key], cache[key])
-    else:
-        resp = await _get_json_response(url)
-        cache.set_with_tag(key, tag=t0, value=resp.json)
 
-    return resp
+async def get_events(owner, *, org=False, etag=None, **kwargs):
+    '''Get the latest public events of a user or organization
+
+    Events are not cached: the caller keeps the ETag of its last poll and
+    passes it back, and polls with nothing new are answered with 304 (which
+    GitHub does not count against the rate limit).  Only the first page is
+    requested.
+
+    Returns (response, events), with no events if none are new.
+    '''
+    url = '{}/{}/events'.format('orgs' if org else 'users', owner)
+    resp = await _get_json_response(url, etag=etag,
+                                    user_params=dict(per_page=per_page),
+                                    **kwargs)
+    if resp.unmodified:
+        return resp, []
+    elif resp.response.status != 200:
+        raise ResponseError(url, resp)
+    return resp, resp.json
 
 
 async def get_tags(owner, repo, **kwargs):
     url = 'repos/{owner}/{repo}/tags'.format(owner=owner, repo=repo)
-    resp = await get_if_newer_than_cache(url, cache=caches['tags'], **kwargs)
-    return resp, resp.json
+    return await get_paginated_response(url, url, cache=caches['tags'],
+                                        **kwargs)
+
+
+def expire_tags(owner, repo):
+    url = 'repos/{owner}/{repo}/tags'.format(owner=owner, repo=repo)
+    expire_paginated(url, caches['tags'])
 
 
 async def get_branches(owner, repo, **kwargs):
     url = 'repos/{owner}/{repo}/branches'.format(owner=owner, repo=repo)
-    resp = await get_if_newer_than_cache(url, cache=caches['branches'],
-                                         **kwargs)
-    return resp, resp.json
+    return await get_paginated_response(url, url, cache=caches['branches'],
+                                        **kwargs)
+
+
+def expire_branches(owner, repo):
+    url = 'repos/{owner}/{repo}/branches'.format(owner=owner, repo=repo)
+    expire_paginated(url, caches['branches'])
 
 
 async def get_branch_info(owner, repo, branch, **kwargs):
     url = ('repos/{owner}/{repo}/branches/{branch}'
            ''.format(owner=owner, repo=repo, branch=branch))
 
-    resp = await get_if_newer_than_cache(url, cache=caches['branches'],
-                                         **kwargs)
-    return resp, resp.json
+    return await get_cached_response(url, url, cache=caches['branches'],
+                                     **kwargs)
 
 
 async def get_commit_info(owner, repo, sha1, **kwargs):
     url = ('repos/{owner}/{repo}/git/commits/{sha1}'
            ''.format(owner=owner, repo=repo, sha1=sha1))
 
-    resp = await get_if_newer_than_cache(url, cache=caches['commits'],
-                                         **kwargs)
-    return resp, resp.json
+    # commits are immutable: once cached, never fetch them again
+    return await get_cached_response(sha1, url, cache=caches['commits'],
+                                     max_age=None, **kwargs)
 
 
+async def get_tree(owner, repo, sha1, **kwargs):
+    url = ('repos/{owner}/{repo}/git/trees/{sha1}'
+           ''.format(owner=owner, repo=repo, sha1=sha1))
+
+    # like commits, trees are immutable
+    return await get_cached_response(sha1, url, cache=caches['trees'],
+                                     max_age=None, **kwargs)
+
+
+async def _get_blob(owner, repo, sha1, **kwargs):
+    url = ('repos/{owner}/{repo}/git/blobs/{sha1}'
+           ''.format(owner=owner, repo=repo, sha1=sha1))
+
+    resp = await _get_json_response(url, **kwargs)
+    if resp.response.status != 200:
+        raise ResponseError(url, resp)
+
+    blob = resp.json
+    if blob.get('encoding', None) == 'base64':
+        return base64.b64decode(blob['content'])
+    return blob['content'].encode('utf-8')
+
+
+async def get_blob(owner, repo, sha1, **kwargs):
+    '''Get the contents of a blob as bytes
+
+    Blobs can be large and are not kept in the response caches.
+    '''
+    return await single_flight.run(
+        ('blobs', sha1),
+        functools.partial(_get_blob, owner, repo, sha1, **kwargs),
+        priority=kwargs.get('priority', BACKGROUND))
+
+
+_tag_refs_query = '''
+query($owner: String!, $name: String!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    refs(refPrefix: "refs/tags/", first: 100, after: $cursor) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        name
+        target {
+          oid
+          ... on Commit { authoredDate tree { oid } }
+          ... on Tag {
+            target { oid ... on Commit { authoredDate tree { oid } } }
+          }
+        }
+      }
+    }
+  }
+}
+'''
+
+
+async def _get_tag_commits_graphql(owner, repo, **kwargs):
+    commit_cache = caches['commits']
+    tags = []
+    cursor = None
+    while True:
+        data = await _post_graphql(_tag_refs_query,
+                                   dict(owner=owner, name=repo,
+                                        cursor=cursor), **kwargs)
+        if data.get('repository') is None:
+            raise GraphQLError('Repository {}/{} not found'.format(owner,
+                                                                  repo),
+                               status=404)
+        refs = data['repository']['refs']
+        for node in refs['nodes']:
+            target = node['target']
+            if 'authoredDate' not in target:
+                # annotated tag; use the commit it points to
+                target = target.get('target', {})
+            if 'authoredDate' not in target:
+                # tags of trees or blobs have no date
+                continue
+
+            sha = target['oid']
+            if sha not in commit_cache:
+                # store the subset of a git/commits response we use
+                commit_cache.set_with_tag(
+                    sha, tag=dict(fetched=time.time()),
+                    value={'sha': sha,
+                           'author': {'date': target['authoredDate']},
+                           'tree': {'sha': target['tree']['oid']},
+                           })
+            tags.append((node['name'], sha, commit_cache[sha]))
+
+        if not refs['pageInfo']['hasNextPage']:
+            return tags
+        cursor = refs['pageInfo']['endCursor']
+
+
+async def get_tag_commits(owner, repo, **kwargs):
+    '''List the tags of a repository with their commit information
+
+    Returns a list of (tag_name, commit_sha, commit_info).  With GraphQL
+    available, tags and their commit dates are read 100 at a time; otherwise
+    the tag list is followed by a git/commits request for every commit not
+    already in the commit cache.
+    '''
+    if use_graphql:
+        return await single_flight.run(
+            ('tag-commits', owner, repo),
+            functools.partial(_get_tag_commits_graphql, owner, repo,
+                              **kwargs),
+            priority=kwargs.get('priority', BACKGROUND))
+
+    _, tags = await get_tags(owner, repo, **kwargs)
+    tags = [(tag['name'], tag['commit']['sha']) for tag in tags]
+    infos = await asyncio.gather(*(get_commit_info(owner, repo, sha, **kwargs)
+                                   for tag_name, sha in tags))
+    return [(tag_name, sha, info)
+            for (tag_name, sha), (_, info) in zip(tags, infos)]
+
+
+def get_statistics():
+    return dict(counters,
+                in_flight=len(single_flight),
+                active=scheduler.active,
+                rate_limit_remaining=scheduler.rate_limit_remaining,
+                rate_limit_reset=scheduler.rate_limit_reset,
+                )
+
+
+async def _main():
+    session = make_session()
+    try:
+        logger.debug('Get user repos')
+        kresp, klauer_repos = await get_user_repos('klauer', session=session)
+        logger.debug('Get org repos')
+        nresp, nsls2_repos = await get_org_repos('nsls-ii', session=session)
+        logger.debug('Get tags')
+        tresp, ophyd_tags = await get_tags('nsls-ii', 'ophyd',
+                                           session=session)
+        logger.debug('Get branches')
+        bresp, ophyd_branches = await get_branches('nsls-ii', 'ophyd',
+                                                   session=session)
+    finally:
+        await session.close()
+
 
 if __name__ == '__main__':
     for loggername in ('gitfuse', '__main__'):
@@ -161,13 +764,5 @@ if __name__ == '__main__':
     logging.basicConfig()
 
     loop = asyncio.get_event_loop()
-    logger.debug('Get user repos')
-    kresp, klauer_repos = loop.run_until_complete(get_user_repos('klauer'))
-    logger.debug('Get org repos')
-    nresp, nsls2_repos = loop.run_until_complete(get_org_repos('nsls-ii'))
-    logger.debug('Get tags')
-    tresp, ophyd_tags = loop.run_until_complete(get_tags('nsls-ii', 'ophyd'))
-    logger.debug('Get branches')
-    bresp, ophyd_branches = loop.run_until_complete(get_branches('nsls-ii',
-                                                                 'ophyd'))
+    loop.run_until_complete(_main())
     loop.close()
@@ -2,32 +2,61 @@
 
 Usage:
   githubfs.py [-v] <mount_point> [--users=<list>] [--orgs=<list>]
-              [--update-rate=<rate>]
+              [--update-rate=<rate>] [--connections-per-host=<n>]
+              [--concurrent-requests=<n>] [--cache=<path>]
+              [--blob-cache=<path>] [--blob-cache-size=<mb>]
+              [--pack-repos=<list>] [--workers=<n>]
+              [--events] [--reconcile-rate=<rate>]
 
 Options:
   --users=<users>         comma-delimited set of users.
   --orgs=<orgs>           comma-delimited set of organizations.
   --update-rate=<rate>    update rate in seconds [default: 60.0].
+  --connections-per-host=<n>  maximum pooled connections to the GitHub API
+                              [default: 20].
+  --concurrent-requests=<n>   maximum GitHub API requests in flight
+                              [default: 8].
+  --cache=<path>          response cache database [default: gitfuse_cache.db].
+  --blob-cache=<path>     file content cache directory
+                          (default: $XDG_CACHE_HOME/gitfuse/blobs).
+  --blob-cache-size=<mb>  file content cache size in MB [default: 1024].
+  --pack-repos=<list>     comma-delimited set of owner/repo to fetch as
+                          packfiles rather than file by file.
+  --workers=<n>           threads serving FUSE requests, or 0 to serve them
+                          on the session thread [default: 8].
+  --events                poll the events of users and organizations every
+                          update rate (or as often as GitHub allows), and
+                          only refresh the repositories they name.
+  --reconcile-rate=<rate>  with --events, seconds between full refreshes
+                           [default: 3600.0].
 '''
 
 import os
+import base64
 import signal
 import time
 import asyncio
 import logging
-import functools
 import threading
 import errno
+import collections
 
 from datetime import datetime
 
 from .fs import FileSystem
-from .ghclient import (get_org_repos, get_user_repos, get_tags, get_branches,
-                       get_branch_info, get_commit_info)
+from . import cache
+from . import ghclient
+from .ghclient import (get_org_repos, get_user_repos, get_tag_commits,
+                       get_branches, get_commit_info, get_tree, get_blob,
+                       get_events, make_session, INTERACTIVE, BACKGROUND)
 from .directory_entry import DirectoryEntry
+from .blobstore import BlobStore, default_path as default_blob_path
+from .gitpack import PackRepository
 
 
 logger = logging.getLogger(__name__)
+# seconds the kernel may cache immutable entries, such as the trees of tags
+immutable_timeout = 365 * 86400.0
 
 
 def iso8601_string_to_posix(string_ts):
@@ -35,15 +64,29 @@ def iso8601_string_to_posix(string_ts):
     return time.mktime(dt.timetuple())
 
 
-def require_initialization(fcn):
-    @functools.wraps(fcn)
-    def inner(self, *args, **kwargs):
-        if not self._initialized:
-            self._initialized = True
-            self.update()
-
-        return fcn(self, *args, **kwargs)
-    return inner
+def event_changes(event):
+    '''What a GitHub event changes in its repository
+
+    Returns a set of 'tags', 'branches' and 'repo' (the repository itself,
+    e.g. created, renamed or made public).
+    '''
+    payload = event.get('payload') or {}
+    event_type = event.get('type')
+    if event_type == 'PushEvent':
+        if payload.get('ref', '').startswith('refs/tags/'):
+            return {'tags'}
+        return {'branches'}
+    elif event_type in ('CreateEvent', 'DeleteEvent'):
+        return {'tag': {'tags'},
+                'branch': {'branches'},
+                'repository': {'repo'},
+                }.get(payload.get('ref_type'), set())
+    elif event_type == 'ReleaseEvent':
+        # publishing a release may create its tag
+        return {'tags'}
+    elif event_type in ('RepositoryEvent', 'PublicEvent'):
+        return {'repo'}
+    return set()
 
 
 class RepoMetadataDirectory(DirectoryEntry):
@@ -51,198 +94,782 @@ class RepoMetadataDirectory(DirectoryEntry):
         self.repo_owner = kwargs.pop('repo_owner')
         self.repo_name = kwargs.pop('repo_name')
         self._initialized = False
+        self._loading = None
+        # bumped by unload, so that updates in progress can tell
+        self._generation = 0
         super().__init__(*args, **kwargs)
 
     @property
-    def loop(self):
-        return self.fuse.loop
+    def session(self):
+        return self.fuse.session
 
-    @require_initialization
-    def __getitem__(self, key):
-        return super().__getitem__(key)
+    @property
+    def initialized(self):
+        return self._initialized
+
+    def ensure_loaded(self):
+        if self._initialized:
+            return None
+
+        with self.lock:
+            if self._loading is None or self._loading.done():
+                # lookups from the FUSE thread jump ahead of background
+                # refresh
+                self._loading = self.fuse.submit(
+                    self.update(priority=INTERACTIVE))
+            return self._loading
+
+    def unload(self):
+        with self.lock:
+            if not self._initialized or not (self._loading is None or
+                                             self._loading.done()):
+                return False
+
+            if self.is_referenced():
+                return False
+
+            self._initialized = False
+            self._generation += 1
+            self.clear()
+            return True
+
+    def unloaded_since(self, generation):
+        '''Whether the directory was unloaded since `generation`
+
+        A background update that finds it was, while awaiting a response,
+        leaves it alone: the entries are listed from scratch on next use.
+        '''
+        return self._generation != generation
+
+    def update_ref(self, ref_name, sha, info):
+        '''Add a tag or branch, or point it at a new commit'''
+        try:
+            ts = info['author']['date']
+        except KeyError:
+            logger.warning('Unexpected commit info for %s/%s %s: %s',
+                           self.repo_owner, self.repo_name, sha, info)
+            return
 
-    @require_initialization
-    def get_entries(self):
-        return super().get_entries()
+        mtime = iso8601_string_to_posix(ts)
+        try:
+            entry = self[ref_name]
+        except KeyError:
+            tree_dir = GitTreeDirectory(self.fuse, self.inode,
+                                        repo_owner=self.repo_owner,
+                                        repo_name=self.repo_name,
+                                        name=ref_name,
+                                        ref=self.ref_prefix + ref_name,
+                                        commit_sha=sha, timestamp=mtime)
+            self.add_dir(ref_name, dirobj=tree_dir)
+            if self._initialized:
+                # drop any negative entry cached by the kernel
+                self.fuse.invalidate_entry(self.inode, ref_name)
+            return
+
+        tree_dir = entry.obj
+        if tree_dir.commit_sha != sha:
+            logger.debug('%s/%s %s moved to %s (%s)', self.repo_owner,
+                         self.repo_name, ref_name, sha, ts)
+            tree_dir.reset(sha, timestamp=mtime)
+            self.changed()
+            self.fuse.invalidate_entry(self.inode, ref_name)
 
 
 class RepoTagDirectory(RepoMetadataDirectory):
-    def update(self):
-        _, tags = self.loop.run_until_complete(get_tags(self.repo_owner,
-                                                        self.repo_name))
+    ref_prefix = 'refs/tags/'
 
-        tags = [(tag['name'], tag['commit']['sha']) for tag in tags]
+    async def update(self, priority=BACKGROUND):
+        generation = self._generation
+        tags = await get_tag_commits(self.repo_owner, self.repo_name,
+                                     session=self.session, priority=priority)
+        if self.unloaded_since(generation):
+            return
 
-        futures = [get_commit_info(self.repo_owner, self.repo_name, sha)
-                   for tag_name, sha in tags]
+        for tag_name, sha, info in tags:
+            self.update_ref(tag_name, sha, info)
 
-        gather_fut = asyncio.gather(*futures)
-        tag_info = self.loop.run_until_complete(gather_fut)
+        tag_names = set(tag_name for tag_name, sha, info in tags)
+        for tag_name in set(self.entry_by_name) - tag_names:
+            logger.debug('%s/%s tag %s removed', self.repo_owner,
+                         self.repo_name, tag_name)
+            self.remove(tag_name)
 
-        for (tag_name, sha), (_, info) in zip(tags, tag_info):
-            try:
-                entry = self[tag_name]
-            except KeyError:
-                entry = self.add_dir(tag_name)
+        self._initialized = True
 
-            attr = entry.attr
-            try:
-                ts = info['author']['date']
-            except KeyError:
-                print(info, list(info.keys()))
+
+class RepoBranchDirectory(RepoMetadataDirectory):
+    ref_prefix = 'refs/heads/'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # branch name -> head commit sha, as of the last update
+        self.heads = {}
+
+    async def update(self, priority=BACKGROUND):
+        generation = self._generation
+        _, branches = await get_branches(self.repo_owner, self.repo_name,
+                                         session=self.session,
+                                         priority=priority)
+
+        heads = {branch['name']: branch['commit']['sha']
+                 for branch in branches}
+        moved = {branch_name: sha for branch_name, sha in heads.items()
+                 if self.heads.get(branch_name) != sha}
+
+        # only resolve dates of new heads; the commit cache never expires
+        shas = list(set(moved.values()))
+        results = await asyncio.gather(
+            *(get_commit_info(self.repo_owner, self.repo_name, sha,
+                              session=self.session, priority=priority)
+              for sha in shas),
+            return_exceptions=True)
+
+        commit_info = {}
+        for sha, result in zip(shas, results):
+            if isinstance(result, Exception):
+                logger.error('Commit %s of %s/%s failed', sha,
+                             self.repo_owner, self.repo_name, exc_info=result)
+            else:
+                commit_info[sha] = result[1]
+
+        if self.unloaded_since(generation):
+            # heads were reset: applying only the moved branches would
+            # leave out the others for good
+            return
+
+        for branch_name, sha in moved.items():
+            if sha in commit_info:
+                self.update_ref(branch_name, sha, commit_info[sha])
+
+        for branch_name in set(self.entry_by_name) - set(heads):
+            logger.debug('%s/%s branch %s removed', self.repo_owner,
+                         self.repo_name, branch_name)
+            self.remove(branch_name)
+
+        # branches whose commit failed count as moved next time, to retry
+        self.heads = {branch_name: sha for branch_name, sha in heads.items()
+                      if branch_name not in moved or sha in commit_info}
+        self._initialized = True
+
+    def unload(self):
+        unloaded = super().unload()
+        if unloaded:
+            self.heads = {}
+        return unloaded
+
+
+class GitTreeDirectory(RepoMetadataDirectory):
+    '''The contents of a git tree, listed on first access
+
+    The top-level directory of a tag or branch is given its ref and commit,
+    from which the tree is found.  Subdirectories are given their tree
+    directly.  Trees and blobs are read from the repository's object source.
+    '''
+    def __init__(self, *args, ref=None, commit_sha=None, tree_sha=None,
+                 **kwargs):
+        self.ref = ref
+        self.commit_sha = commit_sha
+        self.tree_sha = tree_sha
+        super().__init__(*args, **kwargs)
+
+    @property
+    def source(self):
+        return self.fuse.object_source(self.repo_owner, self.repo_name)
+
+    @property
+    def cache_timeout(self):
+        # trees of branches change as they move; those of tags do not
+        if self.ref is not None and self.ref.startswith('refs/tags/'):
+            return immutable_timeout
+        return None
+
+    def reset(self, commit_sha, timestamp):
+        '''Point the directory at a different commit'''
+        with self.lock:
+            self._generation += 1
+            self.clear()
+
+            self.entry.mtime = self.entry.ctime = timestamp
+            self.commit_sha = commit_sha
+            self.tree_sha = None
+            self._initialized = False
+        self.fuse.invalidate_inode(self.inode)
+
+    async def update(self, priority=BACKGROUND):
+        source = self.source
+        while True:
+            generation = self._generation
+            commit_sha, tree_sha = self.commit_sha, self.tree_sha
+            if tree_sha is None:
+                tree_sha = await source.get_commit_tree(self.ref, commit_sha,
+                                                        priority=priority)
+            if not self.unloaded_since(generation):
+                tree = await source.get_tree(tree_sha, priority=priority)
+                if not self.unloaded_since(generation):
+                    break
+
+            # reset to another commit while fetching (a tree directory is
+            # not unloaded while loading): list that commit's tree instead
+            logger.debug('%s/%s %s moved while listing %r', self.repo_owner,
+                         self.repo_name, self.ref, self.entry.name)
+
+        self.tree_sha = tree_sha
+        for item in tree:
+            name = item['path']
+            if name in self.entry_by_name:
+                continue
+
+            if item['type'] == 'tree':
+                subdir = GitTreeDirectory(self.fuse, self.inode,
+                                          repo_owner=self.repo_owner,
+                                          repo_name=self.repo_name,
+                                          name=name, ref=self.ref,
+                                          tree_sha=item['sha'],
+                                          timestamp=self.entry.mtime)
+                self.add_dir(name, dirobj=subdir)
+            elif item['type'] == 'blob':
+                blob = GitBlob(self.fuse, source, item['sha'], item['size'])
+                if item['mode'] == '120000':
+                    self.add_link(name, None, obj=blob)
+                else:
+                    self.add_file(name, obj=blob)
             else:
-                mtime = iso8601_string_to_posix(ts)
-                if attr['st_ctime'] != mtime:
-                    attr['st_ctime'] = attr['st_mtime'] = mtime
-                    logger.debug('%s/%s tag %s updated at %s', self.repo_owner,
-                                 self.repo_name, tag_name, ts)
+                # submodules are shown as empty directories
+                self.add_dir(name)
 
-        # TODO remove entries that are no longer there
+        self._initialized = True
 
 
-class RepoBranchDirectory(RepoMetadataDirectory):
-    def update(self):
-        fut = get_branches(self.repo_owner, self.repo_name)
-        _, branches = self.loop.run_until_complete(fut)
+class GitBlob:
+    '''The contents of a git blob, fetched into the blob store when read'''
+    __slots__ = ('fuse', 'source', 'sha', 'size', '_loading')
 
-        branch_names = [branch['name'] for branch in branches]
+    def __init__(self, fuse, source, sha, size):
+        self.fuse = fuse
+        self.source = source
+        self.sha = sha
+        self.size = size
+        self._loading = None
 
-        futures = [get_branch_info(self.repo_owner, self.repo_name,
-                                   branch_name)
-                   for branch_name in branch_names]
+    def __len__(self):
+        return self.size
 
-        gather_fut = asyncio.gather(*futures)
-        branch_info = self.loop.run_until_complete(gather_fut)
+    def ensure_loaded(self):
+        if self.sha in self.fuse.blob_store:
+            return None
 
-        for branch_name, (_, info) in zip(branch_names, branch_info):
-            try:
-                entry = self[branch_name]
-            except KeyError:
-                entry = self.add_dir(branch_name)
+        # blobs are too many for a lock each
+        with self.fuse.lock:
+            if self._loading is None or self._loading.done():
+                self._loading = self.fuse.submit(
+                    self.load(priority=INTERACTIVE))
+            return self._loading
+
+    async def load(self, priority=BACKGROUND):
+        if self.sha not in self.fuse.blob_store:
+            data = await self.source.get_blob(self.sha, priority=priority)
+            # written from a thread, not to hold up the event loop
+            await asyncio.get_event_loop().run_in_executor(
+                None, self.fuse.blob_store.put, self.sha, data)
+
+    def read(self, size, offset):
+        return self.fuse.blob_store.read(self.sha, size, offset)
+
+
+class RestObjectSource:
+    '''Reads trees and blobs with a GitHub API request for each'''
+    def __init__(self, fuse, repo_owner, repo_name):
+        self.fuse = fuse
+        self.repo_owner = repo_owner
+        self.repo_name = repo_name
+
+    async def get_commit_tree(self, ref, sha, *, priority=BACKGROUND):
+        _, commit = await get_commit_info(self.repo_owner, self.repo_name,
+                                          sha, session=self.fuse.session,
+                                          priority=priority)
+        return commit['tree']['sha']
+
+    async def get_tree(self, sha, *, priority=BACKGROUND):
+        _, tree = await get_tree(self.repo_owner, self.repo_name, sha,
+                                 session=self.fuse.session,
+                                 priority=priority)
+        if tree.get('truncated', False):
+            logger.warning('Listing of %s/%s tree %s is incomplete',
+                           self.repo_owner, self.repo_name, sha)
+        return tree['tree']
+
+    async def get_blob(self, sha, *, priority=BACKGROUND):
+        return await get_blob(self.repo_owner, self.repo_name, sha,
+                              session=self.fuse.session, priority=priority)
+
+    async def close(self):
+        pass
 
-            attr = entry.attr
-            try:
-                ts = info['commit']['commit']['author']['date']
-            except KeyError:
-                print(info, list(info.keys()))
-            else:
-                mtime = iso8601_string_to_posix(ts)
-                if attr['st_ctime'] != mtime:
-                    attr['st_ctime'] = attr['st_mtime'] = mtime
-                    logger.debug('%s/%s branch %s updated at %s',
-                                 self.repo_owner, self.repo_name, branch_name,
-                                 ts)
+
+class PackObjectSource:
+    '''Reads trees and blobs from shallow packfile fetches of each ref
+
+    Listing a tag or branch costs one bulk transfer of its commit, after
+    which its trees and blobs are read locally.
+    '''
+    def __init__(self, pack):
+        self.pack = pack
+
+    async def get_commit_tree(self, ref, sha, *, priority=BACKGROUND):
+        await self.pack.fetch(ref, sha)
+        return await self.pack.get_commit_tree(sha)
+
+    async def get_tree(self, sha, *, priority=BACKGROUND):
+        return await self.pack.ls_tree(sha)
+
+    async def get_blob(self, sha, *, priority=BACKGROUND):
+        return await self.pack.read_blob(sha)
+
+    async def close(self):
+        await self.pack.close()
 
 
 class GithubFileSystem(FileSystem):
     def __init__(self, mount_point, users=None, organizations=None,
-                 update_rate=60.0, **kwargs):
+                 update_rate=60.0, session_options=None, concurrency=None,
+                 blob_store=None, pack_repos=None,
+                 pack_url='https://github.com/{owner}/{repo}.git',
+                 pack_dir='gitfuse_packs', auto_update=True, events=False,
+                 reconcile_rate=3600.0, **kwargs):
         if users is None:
             users = []
         if organizations is None:
             organizations = []
 
-        self.loop = asyncio.get_event_loop()
+        # All network I/O runs on this loop in its own thread; the FUSE and
+        # update threads only submit coroutines to it
+        self.loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(target=self._run_loop,
+                                             daemon=True)
+        self._loop_thread.start()
+
         self.monitoring = dict(users=list(users),
                                organizations=list(organizations),
                                )
         self.update_rate = update_rate
+        # listings are refreshed every update_rate; the kernel is told of
+        # changes, but may go on caching what it was not told about
+        self.cache_timeout = update_rate
+        # concurrency of each refresh stage: listing the repositories of
+        # users/organizations, and refreshing the tags/branches of a repo
+        concurrency = dict(dict(owners=4, refs=16), **(concurrency or {}))
+        self._limits = {stage: asyncio.Semaphore(limit)
+                        for stage, limit in concurrency.items()}
+        # (owner, repo) -> pushed_at as of the last refresh of its refs
+        self._pushed_at = {}
+        self.update_history = collections.deque(maxlen=100)
+        self.session_options = dict(session_options or {})
+        self.session = None
+        if blob_store is None:
+            blob_store = BlobStore(default_blob_path())
+        self.blob_store = blob_store
+        # repositories ('owner/repo') read from packfiles instead of the API
+        self.pack_repos = set(pack_repos or [])
+        self.pack_url = pack_url
+        self.pack_dir = pack_dir
+        self._object_sources = {}
+        # refresh every update_rate in a thread, rather than by calling update
+        self.auto_update = auto_update
+        # with events, refresh only what the events of each owner name, and
+        # everything every reconcile_rate in case an event was missed
+        self.events = events
+        self.reconcile_rate = reconcile_rate
+        # (kind, owner) -> dict(etag, last_id, next_poll) of its events
+        self._event_state = {}
+        # (owner, repo) -> created_at of the latest event its refs were
+        # refreshed for, so that the next reconcile need not repeat it
+        self._events_handled = {}
         super().__init__(mount_point, **kwargs)
 
     def init(self, userdata, conn):
         super().init(userdata, conn)
 
+        self.session = self.run(self._open_session())
+
         root = self.root
         self.users = root.add_dir('users').obj
         self.orgs = root.add_dir('orgs').obj
-        self._update_thread = threading.Thread(target=self.update_loop)
-        self._update_thread.daemon = True
-        self._update_thread.start()
+        if self.auto_update:
+            self._update_thread = threading.Thread(target=self.update_loop)
+            self._update_thread.daemon = True
+            self._update_thread.start()
 
-    def update_loop(self):
+    def _run_loop(self):
         asyncio.set_event_loop(self.loop)
-        while True:
-            self.update()
-            time.sleep(self.update_rate)
+        self.loop.run_forever()
+
+    def submit(self, coro):
+        '''Schedule a coroutine on the event loop thread
+
+        Returns a concurrent.futures.Future which may be waited on or given
+        callbacks from any thread.
+        '''
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        '''Run a coroutine on the event loop thread and wait for its result'''
+        return self.submit(coro).result()
+
+    def get_statistics(self):
+        statistics = super().get_statistics()
+
+        github = ghclient.get_statistics()
+        github['not_modified_ratio'] = (github.get('not_modified', 0) /
+                                        max(github.get('requests', 0), 1))
+
+        caches = {}
+        for name, tagged_cache in cache.caches.items():
+            caches[name] = cache_stats = tagged_cache.get_statistics()
+            cache_stats['hit_rate'] = (
+                cache_stats['hits'] /
+                max(cache_stats['hits'] + cache_stats['misses'], 1))
+
+        blob_store = self.blob_store.get_statistics()
+        blob_store['hit_rate'] = (blob_store['hits'] /
+                                  max(blob_store['hits'] +
+                                      blob_store['misses'], 1))
+
+        history = list(self.update_history)
+        updates = dict(cycles=len(history))
+        if history:
+            updates.update(
+                last=history[-1],
+                mean_duration=(sum(cycle['duration'] for cycle in history) /
+                               len(history)))
+
+        statistics.update(github=github, caches=caches,
+                          blob_store=blob_store, updates=updates,
+                          update_history=history)
+        return statistics
+
+    async def _open_session(self):
+        return make_session(**self.session_options)
+
+    def object_source(self, repo_owner, repo_name):
+        '''Where the trees and blobs of a repository are read from'''
+        key = (repo_owner, repo_name)
+        try:
+            return self._object_sources[key]
+        except KeyError:
+            pass
+
+        if '{}/{}'.format(repo_owner, repo_name) in self.pack_repos:
+            config = {}
+            if ghclient.access_token is not None:
+                credentials = base64.b64encode(
+                    'x-access-token:{}'.format(ghclient.access_token)
+                    .encode('utf-8')).decode('ascii')
+                config['http.extraHeader'] = ('Authorization: Basic {}'
+                                              ''.format(credentials))
+
+            pack = PackRepository(
+                self.pack_url.format(owner=repo_owner, repo=repo_name),
+                os.path.join(self.pack_dir, repo_owner, repo_name + '.git'),
+                config=config)
+            source = PackObjectSource(pack)
+        else:
+            source = RestObjectSource(self, repo_owner, repo_name)
 
-    def update(self):
-        self.update_users()
-        self.update_organizations()
+        self._object_sources[key] = source
+        return source
 
-    def update_users(self):
-        for user in self.monitoring['users']:
-            try:
-                entry = self.users[user]
-            except KeyError:
-                entry = self.users.add_dir(user)
+    async def _close(self):
+        for source in self._object_sources.values():
+            await source.close()
 
-            user_dir = entry.obj
-            _, repos = self.loop.run_until_complete(get_user_repos(user))
-            logger.debug('-- User: %s --', user)
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
 
-            for repo in repos:
-                self.update_repo(user_dir, repo)
+    def destroy(self, userdata):
+        super().destroy(userdata)
+        self.run(self._close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
 
-    def update_organizations(self):
-        for org in self.monitoring['organizations']:
+    def update_loop(self):
+        if self.events:
+            return self.event_loop()
+
+        while True:
             try:
-                entry = self.orgs[org]
-            except KeyError:
-                entry = self.orgs.add_dir(org)
+                self.run(self.update())
+            except Exception as ex:
+                logger.error('Update failed', exc_info=ex)
+            time.sleep(self.update_rate)
 
-            org_dir = entry.obj
-            _, repos = self.loop.run_until_complete(get_org_repos(org))
-            logger.debug('-- Organization: %s --', org)
-            for repo in repos:
-                self.update_repo(org_dir, repo)
+    def event_loop(self):
+        '''Refresh what events name, and everything every reconcile_rate'''
+        next_update = 0.0
+        while True:
+            try:
+                # events from before a full refresh need not be acted on
+                delay = self.run(self.poll_events())
+                if time.time() >= next_update:
+                    next_update = time.time() + self.reconcile_rate
+                    self.run(self.update())
+            except Exception as ex:
+                logger.error('Update failed', exc_info=ex)
+                delay = self.update_rate
+            time.sleep(max(min(delay, next_update - time.time()), 1.0))
+
+    def _owners(self):
+        '''(parent directory, owner, get_repos, org) of each monitored owner'''
+        return ([(self.users, user, get_user_repos, False)
+                 for user in self.monitoring['users']] +
+                [(self.orgs, org, get_org_repos, True)
+                 for org in self.monitoring['organizations']])
+
+    async def poll_events(self):
+        '''Poll the events of the owners that are due to be polled
+
+        Returns the seconds until the next owner is due.
+        '''
+        now = time.time()
+        owners = [owner for owner in self._owners()
+                  if self._event_state.get((owner[3], owner[1]),
+                                           {}).get('next_poll', 0.0) <= now]
+        results = await asyncio.gather(*(self.poll_owner_events(*owner)
+                                         for owner in owners),
+                                       return_exceptions=True)
+        for (_, owner, _, _), result in zip(owners, results):
+            if isinstance(result, Exception):
+                logger.error('Events of %s failed', owner, exc_info=result)
+
+        next_poll = min((state['next_poll']
+                         for state in self._event_state.values()),
+                        default=now + self.update_rate)
+        return next_poll - time.time()
+
+    async def poll_owner_events(self, parent_obj, owner, get_repos, org):
+        '''Refresh the repositories and refs named in new events of an owner
+
+        The first poll only notes where the events start.  If a whole page
+        of events is new, some may have been missed, and all repositories of
+        the owner are refreshed instead.
+        '''
+        state = self._event_state.setdefault(
+            (org, owner), dict(etag=None, last_id=None, next_poll=0.0))
+        try:
+            resp, events = await get_events(owner, org=org,
+                                            etag=state['etag'],
+                                            session=self.session)
+        except Exception:
+            state['next_poll'] = time.time() + self.update_rate
+            raise
+
+        state['next_poll'] = time.time() + max(self.update_rate,
+                                               resp.poll_interval or 0)
+        if resp.unmodified:
+            return
+
+        state['etag'] = resp.etag
+        last_id = state['last_id']
+        ids = [int(event['id']) for event in events]
+        state['last_id'] = max(ids + [last_id or 0])
+        if last_id is None:
+            return
+
+        new_events = [event for event, event_id in zip(events, ids)
+                      if event_id > last_id]
+        if len(new_events) >= ghclient.per_page:
+            logger.info('Events of %s may have been missed; refreshing all '
+                        'of its repositories', owner)
+            ghclient.expire_repos(owner, org=org)
+            await self.update_owner(parent_obj, owner, get_repos)
+            return
+
+        changes = collections.defaultdict(set)
+        latest = {}
+        for event in new_events:
+            repo_owner, _, repo_name = event['repo']['name'].partition('/')
+            # user events include those of other owners' repositories
+            if repo_owner.lower() == owner.lower():
+                changes[repo_name] |= event_changes(event)
+                key = (repo_owner, repo_name)
+                latest[key] = max(latest.get(key, ''),
+                                  event.get('created_at') or '')
 
-    def update_repo(self, parent_obj, repo):
+        try:
+            owner_dir = parent_obj[owner].obj
+        except KeyError:
+            owner_dir = None
+
+        if owner_dir is None or any(
+                'repo' in changed or repo_name not in owner_dir.entry_by_name
+                for repo_name, changed in changes.items() if changed):
+            logger.debug('Events of %s changed its repositories', owner)
+            ghclient.expire_repos(owner, org=org)
+            await self.update_owner(parent_obj, owner, get_repos)
+            return
+
+        await asyncio.gather(*(self.refresh_refs(owner_dir, repo_owner,
+                                                 repo_name, changes[repo_name],
+                                                 created_at=created_at)
+                               for (repo_owner, repo_name), created_at
+                               in latest.items()
+                               if changes[repo_name]))
+
+    async def refresh_refs(self, owner_dir, repo_owner, repo_name, changed, *,
+                           created_at=None):
+        '''Refresh the tags and/or branches of a repository
+
+        With `created_at`, that of the latest event handled, later updates
+        skip the repository until it is pushed to again.
+        '''
+        logger.debug('Events changed %s of %s/%s', ', '.join(sorted(changed)),
+                     repo_owner, repo_name)
+        repo_dir = owner_dir[repo_name].obj
+        async with self._limits['refs']:
+            if 'tags' in changed:
+                ghclient.expire_tags(repo_owner, repo_name)
+                await self.update_tags(repo_dir, repo_owner, repo_name)
+            if 'branches' in changed:
+                ghclient.expire_branches(repo_owner, repo_name)
+                await self.update_branches(repo_dir, repo_owner, repo_name)
+
+        if created_at:
+            key = (repo_owner, repo_name)
+            self._events_handled[key] = max(
+                self._events_handled.get(key, ''), created_at)
+
+    async def update(self):
+        '''Refresh all monitored users and organizations concurrently'''
+        t0 = time.time()
+        counters = ghclient.counters
+        requests0 = counters['requests'] + counters['graphql']
+
+        owners = self._owners()
+        results = await asyncio.gather(*(self.update_owner(*owner[:3])
+                                         for owner in owners),
+                                       return_exceptions=True)
+
+        failed = 0
+        for (_, owner, _, _), result in zip(owners, results):
+            if isinstance(result, Exception):
+                logger.error('Update of %s failed', owner, exc_info=result)
+                failed += 1
+            else:
+                failed += result
+
+        cycle = dict(started=t0, duration=time.time() - t0,
+                     requests=(counters['requests'] + counters['graphql'] -
+                               requests0),
+                     failed=failed)
+        self.update_history.append(cycle)
+        logger.debug('Update cycle took %.2f s with %d requests (%d failed)',
+                     cycle['duration'], cycle['requests'], failed)
+        return cycle
+
+    async def update_owner(self, parent_obj, owner, get_repos):
+        '''Refresh the repositories of a user or organization
+
+        Returns the number of repositories that failed to update.
+        '''
+        try:
+            entry = parent_obj[owner]
+        except KeyError:
+            entry = parent_obj.add_dir(owner)
+            self.invalidate_entry(parent_obj.inode, owner)
+
+        owner_dir = entry.obj
+        async with self._limits['owners']:
+            _, repos = await get_repos(owner, session=self.session)
+
+        logger.debug('-- %s: %d repositories --', owner, len(repos))
+        results = await asyncio.gather(*(self.update_repo(owner_dir, repo)
+                                         for repo in repos),
+                                       return_exceptions=True)
+
+        failed = 0
+        for repo, result in zip(repos, results):
+            if isinstance(result, Exception):
+                logger.error('Update of %s/%s failed', owner, repo['name'],
+                             exc_info=result)
+                failed += 1
+
+        for repo_name in set(owner_dir.entry_by_name) - set(
+                repo['name'] for repo in repos):
+            logger.debug('Repo %s/%s removed', owner, repo_name)
+            owner_dir.remove(repo_name)
+            self._pushed_at.pop((owner, repo_name), None)
+            self._events_handled.pop((owner, repo_name), None)
+
+        return failed
+
+    async def update_repo(self, parent_obj, repo):
         repo_name = repo['name']
 
         try:
             entry = parent_obj[repo_name]
         except KeyError:
             entry = parent_obj.add_dir(repo_name)
+            self.invalidate_entry(parent_obj.inode, repo_name)
 
-        attr, repo_dir = entry.attr, entry.obj
+        repo_dir = entry.obj
 
         updated_at = iso8601_string_to_posix(repo['updated_at'])
         repo_owner = repo['owner']['login']
-        if attr['st_mtime'] != updated_at:
+        if entry.mtime != updated_at:
             logger.debug('Repo %s/%s updated at: %s', repo_owner, repo_name,
                          repo['updated_at'])
-            attr['st_mtime'] = updated_at
-            attr['st_ctime'] = iso8601_string_to_posix(repo['created_at'])
-
-            self.update_tags(repo_dir, repo_owner, repo_name)
-        else:
+            entry.mtime = updated_at
+            entry.ctime = iso8601_string_to_posix(repo['created_at'])
+            parent_obj.changed()
+            self.invalidate_inode(entry.inode)
+
+        # tags and branches only change with a push
+        key = (repo_owner, repo_name)
+        pushed_at = repo.get('pushed_at', None) or repo['updated_at']
+        if self._pushed_at.get(key, None) == pushed_at:
             logger.debug('Repo %s unmodified', repo_name)
-
-        self.update_branches(repo_dir, repo_owner, repo_name)
-
-    def update_tags(self, repo_dir, repo_owner, repo_name):
+            return
+        elif pushed_at <= self._events_handled.get(key, ''):
+            # ISO 8601 timestamps in UTC sort as strings
+            logger.debug('Repo %s already refreshed for its events',
+                         repo_name)
+            self._pushed_at[key] = pushed_at
+            return
+
+        async with self._limits['refs']:
+            await asyncio.gather(
+                self.update_tags(repo_dir, repo_owner, repo_name),
+                self.update_branches(repo_dir, repo_owner, repo_name))
+        self._pushed_at[key] = pushed_at
+
+    async def update_tags(self, repo_dir, repo_owner, repo_name):
         try:
             entry = repo_dir['tags']
         except KeyError:
-            tag_dir = RepoTagDirectory(self, repo_dir.inode,
+            tag_dir = RepoTagDirectory(self, repo_dir.inode, name='tags',
                                        repo_owner=repo_owner,
                                        repo_name=repo_name)
             entry = repo_dir.add_dir('tags', dirobj=tag_dir)
+            self.invalidate_entry(repo_dir.inode, 'tags')
         else:
             tag_dir = entry.obj
-            tag_dir.update()
+            # directories never listed are fetched on first access instead
+            if tag_dir.initialized:
+                await tag_dir.update()
 
-    def update_branches(self, repo_dir, repo_owner, repo_name):
+    async def update_branches(self, repo_dir, repo_owner, repo_name):
         try:
             entry = repo_dir['branches']
         except KeyError:
             branch_dir = RepoBranchDirectory(self, repo_dir.inode,
+                                             name='branches',
                                              repo_owner=repo_owner,
                                              repo_name=repo_name)
             entry = repo_dir.add_dir('branches', dirobj=branch_dir)
+            self.invalidate_entry(repo_dir.inode, 'branches')
         else:
             branch_dir = entry.obj
-            branch_dir.update()
+            if branch_dir.initialized:
+                await branch_dir.update()
 
     def mkdir(self, req, parent, name, mode):
         if parent == self.root.inode and name.decode('utf-8') == 'exit':
@@ -251,9 +878,20 @@ class GithubFileSystem(FileSystem):
         self.reply_err(req, errno.EIO)
 
 
-def main(mount_point, users, orgs, update_rate):
+def main(mount_point, users, orgs, update_rate, connections_per_host=20,
+         concurrent_requests=8, cache_fn=None, blob_cache=None,
+         blob_cache_size=1024, pack_repos=None, workers=8, events=False,
+         reconcile_rate=3600.0):
+    ghclient.scheduler.max_concurrency = concurrent_requests
+    if cache_fn is not None and cache_fn != cache.backend.fn:
+        cache.set_backend(cache.SQLiteBackend(cache_fn))
     GithubFileSystem(mount_point, users=users, organizations=orgs,
-                     update_rate=update_rate)
+                     update_rate=update_rate,
+                     session_options=dict(limit_per_host=connections_per_host),
+                     blob_store=BlobStore(blob_cache or default_blob_path(),
+                                          max_bytes=blob_cache_size << 20),
+                     pack_repos=pack_repos, workers=workers, events=events,
+                     reconcile_rate=reconcile_rate)
 
 
 if __name__ == "__main__":
@@ -268,4 +906,14 @@ if __name__ == "__main__":
     main(mount_point=args['<mount_point>'],
          users=args['--users'].split(','),
          orgs=args['--orgs'].split(','),
-         update_rate=float(args['--update-rate']))
+         update_rate=float(args['--update-rate']),
+         connections_per_host=int(args['--connections-per-host']),
+         concurrent_requests=int(args['--concurrent-requests']),
+         cache_fn=args['--cache'],
+         blob_cache=args['--blob-cache'],
+         blob_cache_size=int(args['--blob-cache-size']),
+         pack_repos=[repo for repo in (args['--pack-repos'] or '').split(',')
+                     if repo],
+         workers=int(args['--workers']),
+         events=args['--events'],
+         reconcile_rate=float(args['--reconcile-rate']))
@@ -0,0 +1,131 @@
+import os
+import asyncio
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+class PackError(Exception):
+    pass
+
+
+class PackRepository:
+    '''A local bare repository of shallow fetches from a remote
+
+    Each ref is fetched with `git fetch --depth=1`, which transfers all of
+    the trees and blobs of its commit as a single packfile over git's smart
+    HTTP protocol (or any other transport git supports, such as file://).
+    git indexes the pack as it is received; trees are then listed with `git
+    ls-tree` and blobs read from a long-running `git cat-file --batch`.
+    '''
+    def __init__(self, url, path, *, git='git', config=None):
+        self.url = url
+        self.path = path
+        self.git = git
+        self.config = dict(config or {})
+        self._fetch_lock = asyncio.Lock()
+        self._batch_lock = asyncio.Lock()
+        self._batch = None
+
+    async def _run_git(self, *args):
+        # configuration (which may include credentials) is passed in the
+        # environment rather than on the command line
+        env = dict(os.environ, GIT_CONFIG_COUNT=str(len(self.config)))
+        for i, (key, value) in enumerate(self.config.items()):
+            env['GIT_CONFIG_KEY_{}'.format(i)] = key
+            env['GIT_CONFIG_VALUE_{}'.format(i)] = value
+
+        proc = await asyncio.create_subprocess_exec(
+            self.git, '--git-dir', self.path, *args,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=env)
+        stdout, stderr = await proc.communicate()
+        if proc.returncode != 0:
+            raise PackError('git {} failed: {}'.format(
+                ' '.join(args), stderr.decode('utf-8', 'replace').strip()))
+        return stdout
+
+    async def _ensure_repository(self):
+        if not os.path.exists(os.path.join(self.path, 'HEAD')):
+            os.makedirs(self.path, exist_ok=True)
+            await self._run_git('init', '--quiet', '--bare')
+            # shallow fetches are never repacked or pruned behind our back
+            await self._run_git('config', 'gc.auto', '0')
+            # and are always kept as packs, however few objects they have
+            await self._run_git('config', 'fetch.unpackLimit', '1')
+
+    async def has_object(self, sha):
+        try:
+            await self._run_git('cat-file', '-e', sha)
+        except PackError:
+            return False
+        return True
+
+    async def fetch(self, ref, sha):
+        '''Fetch the commit `sha` of `ref`, unless it is already present'''
+        async with self._fetch_lock:
+            await self._ensure_repository()
+            if await self.has_object(sha):
+                return
+
+            logger.debug('Fetching %s %s from %s', ref, sha, self.url)
+            await self._run_git('fetch', '--quiet', '--depth=1', '--no-tags',
+                                self.url, ref)
+            if not await self.has_object(sha):
+                # the ref moved on since it was listed; ask for the commit
+                await self._run_git('fetch', '--quiet', '--depth=1',
+                                    '--no-tags', self.url, sha)
+
+    async def get_commit_tree(self, sha):
+        stdout = await self._run_git('rev-parse', '{}^{{tree}}'.format(sha))
+        return stdout.decode('ascii').strip()
+
+    async def ls_tree(self, sha):
+        '''List a tree, with entries as returned by the GitHub trees API'''
+        stdout = await self._run_git('ls-tree', '-l', '-z', sha)
+        entries = []
+        for line in stdout.split(b'\0'):
+            if not line:
+                continue
+
+            info, path = line.split(b'\t', 1)
+            mode, type_, object_sha, size = info.decode('ascii').split()
+            entry = dict(path=path.decode('utf-8', 'surrogateescape'),
+                         mode=mode, type=type_, sha=object_sha)
+            if size != '-':
+                entry['size'] = int(size)
+            entries.append(entry)
+        return entries
+
+    async def read_blob(self, sha):
+        async with self._batch_lock:
+            if self._batch is None or self._batch.returncode is not None:
+                self._batch = await asyncio.create_subprocess_exec(
+                    self.git, '--git-dir', self.path, 'cat-file', '--batch',
+                    stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE)
+
+            batch = self._batch
+            batch.stdin.write(sha.encode('ascii') + b'\n')
+            await batch.stdin.drain()
+            header = (await batch.stdout.readline()).decode('ascii').split()
+            if len(header) != 3:
+                raise PackError('Object {} not in {}'.format(sha, self.path))
+
+            _, type_, size = header
+            data = await batch.stdout.readexactly(int(size))
+            # each object is followed by a newline
+            await batch.stdout.readexactly(1)
+
+        if type_ != 'blob':
+            raise PackError('{} is a {}, not a blob'.format(sha, type_))
+        return data
+
+    async def close(self):
+        if self._batch is not None and self._batch.returncode is None:
+            self._batch.stdin.close()
+            await self._batch.wait()
+        self._batch = None
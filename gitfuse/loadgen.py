@@ -0,0 +1,220 @@
+'''
+Drive a mounted filesystem with parallel stat/readdir/read/readlink calls
+
+The tree under <path> is first walked (up to --max-paths entries) to find
+directories, files and symlinks.  Then --threads threads each pick an
+operation by the weights of --mix and a random target for it, until
+--duration seconds have passed.  The latency percentiles and rate of each
+operation are reported, by the FUSE callback that serves it.
+
+Pass --drop-caches to have the kernel drop cached entries first (requires
+root); otherwise, most calls after the walk are answered from the kernel's
+caches, within the filesystem's attribute and entry timeouts.
+
+Usage:
+  loadgen.py [-v] <path> [--threads=<n>] [--duration=<s>] [--mix=<mix>]
+             [--max-paths=<n>] [--read-size=<bytes>] [--seed=<n>]
+             [--drop-caches]
+
+Options:
+  --threads=<n>        number of threads issuing calls [default: 8].
+  --duration=<s>       seconds to run for [default: 10].
+  --mix=<mix>          weights of each operation
+                       [default: stat=4,readdir=1,read=4,readlink=1].
+  --max-paths=<n>      maximum entries to find in the walk [default: 100000].
+  --read-size=<bytes>  size of each read [default: 131072].
+  --seed=<n>           random seed [default: 0].
+  --drop-caches        drop the kernel's dentry and inode caches first.
+'''
+
+import os
+import time
+import random
+import logging
+import threading
+import collections
+
+
+logger = logging.getLogger(__name__)
+
+# the FUSE callback that each operation exercises
+callbacks = {'stat': 'lookup/getattr',
+             'readdir': 'readdir',
+             'read': 'read',
+             'readlink': 'readlink',
+             }
+
+
+def find_paths(top, max_paths=100000):
+    '''Walk `top`, returning {'dirs': [...], 'files': [...], 'links': [...]}'''
+    paths = dict(dirs=[top], files=[], links=[])
+    count = 0
+    for dirpath, dirnames, filenames in os.walk(top):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            if os.path.islink(path):
+                paths['links'].append(path)
+            elif name in dirnames:
+                paths['dirs'].append(path)
+            else:
+                paths['files'].append(path)
+            count += 1
+
+        if count >= max_paths:
+            break
+
+    # os.walk does not follow symlinks to directories; neither will we
+    return paths
+
+
+def _stat(path, read_size):
+    os.lstat(path)
+
+
+def _readdir(path, read_size):
+    with os.scandir(path) as it:
+        for entry in it:
+            pass
+
+
+def _read(path, read_size):
+    with open(path, 'rb', buffering=0) as f:
+        while f.read(read_size):
+            pass
+
+
+def _readlink(path, read_size):
+    os.readlink(path)
+
+
+operations = {'stat': (_stat, ('files', 'dirs', 'links')),
+              'readdir': (_readdir, ('dirs', )),
+              'read': (_read, ('files', )),
+              'readlink': (_readlink, ('links', )),
+              }
+
+
+def parse_mix(mix):
+    '''Parse 'op=weight,...' into {op: weight}'''
+    weights = {}
+    for item in mix.split(','):
+        op, _, weight = item.partition('=')
+        op = op.strip()
+        if op not in operations:
+            raise ValueError('Unknown operation: {}'.format(op))
+        weights[op] = float(weight or 1)
+    return weights
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return float('nan')
+    index = min(int(fraction * len(sorted_values)), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def _worker(paths, weights, deadline, read_size, seed, latencies, errors):
+    rand = random.Random(seed)
+    ops = [op for op in weights
+           if any(paths[kind] for kind in operations[op][1])]
+    op_weights = [weights[op] for op in ops]
+    if not ops:
+        return
+
+    while time.monotonic() < deadline:
+        op = rand.choices(ops, op_weights)[0]
+        func, kinds = operations[op]
+        targets = paths[rand.choice([kind for kind in kinds if paths[kind]])]
+        path = rand.choice(targets)
+        t0 = time.perf_counter()
+        try:
+            func(path, read_size)
+        except OSError as ex:
+            errors[op] += 1
+            logger.debug('%s of %s failed: %s', op, path, ex)
+            continue
+        latencies[op].append(time.perf_counter() - t0)
+
+
+def run(path, *, threads=8, duration=10.0, mix=None, max_paths=100000,
+        read_size=131072, seed=0, drop_caches=False):
+    '''Run the workload, returning {op: statistics}'''
+    if mix is None:
+        mix = dict(stat=4, readdir=1, read=4, readlink=1)
+
+    t0 = time.perf_counter()
+    paths = find_paths(path, max_paths=max_paths)
+    logger.info('Walked %d directories, %d files and %d links in %.1f s',
+                len(paths['dirs']), len(paths['files']), len(paths['links']),
+                time.perf_counter() - t0)
+
+    if drop_caches:
+        os.sync()
+        with open('/proc/sys/vm/drop_caches', 'w') as f:
+            f.write('2\n')
+
+    deadline = time.monotonic() + duration
+    per_thread = []
+    workers = []
+    for i in range(threads):
+        latencies = collections.defaultdict(list)
+        errors = collections.Counter()
+        per_thread.append((latencies, errors))
+        workers.append(threading.Thread(
+            target=_worker, args=(paths, mix, deadline, read_size,
+                                  seed + i, latencies, errors),
+            daemon=True))
+
+    t0 = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - t0
+
+    results = {}
+    for op in mix:
+        values = sorted(value for latencies, _ in per_thread
+                        for value in latencies[op])
+        results[op] = dict(callback=callbacks[op],
+                           count=len(values),
+                           errors=sum(errors[op] for _, errors in per_thread),
+                           ops_per_sec=len(values) / elapsed,
+                           p50=percentile(values, 0.5),
+                           p99=percentile(values, 0.99),
+                           )
+    return results
+
+
+def format_results(results):
+    lines = ['{:<10} {:<16} {:>10} {:>8} {:>12} {:>10} {:>10}'.format(
+        'operation', 'callback', 'calls', 'errors', 'ops/sec', 'p50 (us)',
+        'p99 (us)')]
+    for op, result in results.items():
+        lines.append('{:<10} {:<16} {:>10d} {:>8d} {:>12.0f} {:>10.1f} '
+                     '{:>10.1f}'.format(op, result['callback'],
+                                        result['count'], result['errors'],
+                                        result['ops_per_sec'],
+                                        result['p50'] * 1e6,
+                                        result['p99'] * 1e6))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__, version='0.1')
+
+    if args['-v']:
+        for loggername in ('gitfuse', '__main__'):
+            logging.getLogger(loggername).setLevel(logging.DEBUG)
+        logging.basicConfig()
+
+    results = run(args['<path>'],
+                  threads=int(args['--threads']),
+                  duration=float(args['--duration']),
+                  mix=parse_mix(args['--mix']),
+                  max_paths=int(args['--max-paths']),
+                  read_size=int(args['--read-size']),
+                  seed=int(args['--seed']),
+                  drop_caches=args['--drop-caches'])
+    print(format_results(results))
@@ -0,0 +1,448 @@
+'''
+A local stand-in for the parts of the GitHub API that gitfuse uses
+
+Point gitfuse at it with GITHUB_API_URL=http://127.0.0.1:<port>.  Every
+user or organization has --repos repositories, each with --tags tags and
+--branches branches, generated on demand.
+
+Usage:
+  mock_github.py [-v] [--port=<port>] [--repos=<n>] [--tags=<n>]
+                 [--branches=<n>] [--latency=<s>] [--rate-limit=<n>]
+
+Options:
+  --port=<port>      port to listen on [default: 8080].
+  --repos=<n>        number of repositories of each owner [default: 10].
+  --tags=<n>         number of tags in each repository [default: 100].
+  --branches=<n>     number of branches in each repository [default: 3].
+  --latency=<s>      seconds to wait before each response [default: 0.0].
+  --rate-limit=<n>   requests allowed per hour [default: 5000].
+'''
+
+import json
+import time
+import base64
+import asyncio
+import hashlib
+import logging
+import itertools
+import collections
+
+from aiohttp import web
+
+
+logger = logging.getLogger(__name__)
+
+
+def fake_sha(*parts):
+    return hashlib.sha1('/'.join(str(part) for part in parts)
+                        .encode('utf-8')).hexdigest()
+
+
+def posix_to_iso8601(ts):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(ts))
+
+
+class MockRepository:
+    '''A repository of generated commits, trees and blobs
+
+    Every commit has a root tree of a README, a symlink to it and a src/
+    directory of `num_files` files; src/ is shared by all commits.
+    '''
+    def __init__(self, owner, name, *, num_tags=100, num_branches=3,
+                 num_files=20, created_at=1.4e9):
+        self.owner = owner
+        self.name = name
+        self.created_at = created_at
+        self.pushed_at = created_at + 3600 * num_tags
+        # sha -> commit, tree or blob
+        self.commits = {}
+        self.trees = {}
+        self.blobs = {}
+
+        src_entries = []
+        for i in range(num_files):
+            sha = self.add_blob('# file {} of {}/{}\n'.format(i, owner, name)
+                                .encode('utf-8'))
+            src_entries.append(dict(path='module{}.py'.format(i),
+                                    mode='100644', type='blob', sha=sha,
+                                    size=len(self.blobs[sha])))
+        self.src_tree = self.add_tree('src', src_entries)
+
+        self.tags = []
+        for i in range(num_tags):
+            self.add_tag('v0.{}'.format(i), created_at + 3600 * i,
+                         annotated=(i % 3 == 0))
+
+        self.branches = {}
+        for i in range(num_branches):
+            branch_name = ('master' if i == 0 else 'branch{}'.format(i))
+            self.branches[branch_name] = self.add_commit(branch_name,
+                                                         self.pushed_at)
+
+    def add_blob(self, data):
+        sha = hashlib.sha1(b'blob ' + str(len(data)).encode('ascii') + b'\0' +
+                           data).hexdigest()
+        self.blobs[sha] = data
+        return sha
+
+    def add_tree(self, label, entries):
+        sha = fake_sha(self.owner, self.name, 'tree', label)
+        self.trees[sha] = entries
+        return sha
+
+    def add_commit(self, label, timestamp):
+        readme = self.add_blob('{}/{} at {}\n'.format(self.owner, self.name,
+                                                      label).encode('utf-8'))
+        tree = self.add_tree(label, [
+            dict(path='README.md', mode='100644', type='blob', sha=readme,
+                 size=len(self.blobs[readme])),
+            dict(path='README', mode='120000', type='blob',
+                 sha=self.add_blob(b'README.md'), size=len(b'README.md')),
+            dict(path='src', mode='040000', type='tree', sha=self.src_tree),
+        ])
+        sha = fake_sha(self.owner, self.name, 'commit', label)
+        self.commits[sha] = dict(sha=sha, date=posix_to_iso8601(timestamp),
+                                 tree=tree)
+        return sha
+
+    def add_tag(self, tag_name, timestamp, *, annotated=False):
+        sha = self.add_commit(tag_name, timestamp)
+        self.tags.append(dict(name=tag_name, sha=sha,
+                              tree=self.commits[sha]['tree'],
+                              date=self.commits[sha]['date'],
+                              annotated=annotated))
+
+    def push(self, branch_name='master'):
+        '''Move a branch to a new commit'''
+        self.pushed_at = max(time.time(), self.pushed_at + 1)
+        label = '{}@{}'.format(branch_name, self.pushed_at)
+        self.branches[branch_name] = self.add_commit(label, self.pushed_at)
+
+    def to_json(self):
+        return {'name': self.name,
+                'full_name': '{}/{}'.format(self.owner, self.name),
+                'owner': {'login': self.owner},
+                'created_at': posix_to_iso8601(self.created_at),
+                'updated_at': posix_to_iso8601(self.pushed_at),
+                'pushed_at': posix_to_iso8601(self.pushed_at),
+                }
+
+    def tag_ref_node(self, tag):
+        commit = {'oid': tag['sha'],
+                  'authoredDate': tag['date'],
+                  'tree': {'oid': tag['tree']},
+                  }
+        if tag['annotated']:
+            target = {'oid': fake_sha(self.owner, self.name, 'tag',
+                                      tag['name']),
+                      'target': commit}
+        else:
+            target = commit
+        return {'name': tag['name'], 'target': target}
+
+
+class MockGithub:
+    '''An in-memory GitHub serving repositories generated on demand
+
+    Listings are paginated with Link headers, responses carry ETags (and
+    conditional requests are answered with 304 Not Modified, which does not
+    count against the rate limit) and every response reports the remaining
+    rate limit.  Each response is delayed by `latency` seconds.  Pushes and
+    new tags made with `push` and `create_tag` are listed as events of the
+    repository's owner.
+    '''
+    max_page_size = 100
+
+    def __init__(self, *, num_repos=10, num_tags=100, num_branches=3,
+                 latency=0.0, rate_limit=5000, owner_sizes=None,
+                 poll_interval=60):
+        self.num_repos = num_repos
+        self.num_tags = num_tags
+        self.num_branches = num_branches
+        self.latency = latency
+        self.rate_limit = rate_limit
+        # owner -> number of repositories, where it differs from num_repos
+        self.owner_sizes = dict(owner_sizes or {})
+        self.poll_interval = poll_interval
+        self.repos = {}
+        # owner -> events of its repositories, newest first
+        self.events = collections.defaultdict(list)
+        self._event_ids = itertools.count(1)
+        self.request_count = 0
+        self.not_modified_count = 0
+        self.requests_by_endpoint = collections.Counter()
+        self._rate_limit_remaining = rate_limit
+        # GraphQL queries have a budget of their own, in points
+        self._graphql_remaining = rate_limit
+        self._rate_limit_reset = time.time() + 3600
+        self._runner = None
+
+    def get_repo(self, owner, name):
+        key = (owner, name)
+        if key not in self.repos:
+            self.repos[key] = MockRepository(owner, name,
+                                             num_tags=self.num_tags,
+                                             num_branches=self.num_branches)
+        return self.repos[key]
+
+    def get_repo_names(self, owner):
+        num_repos = self.owner_sizes.get(owner, self.num_repos)
+        return ['repo{:04d}'.format(i) for i in range(num_repos)]
+
+    def add_event(self, repo, event_type, payload, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        events = self.events[repo.owner]
+        events.insert(0, {'id': str(next(self._event_ids)),
+                          'type': event_type,
+                          'repo': {'name': '{}/{}'.format(repo.owner,
+                                                          repo.name)},
+                          'payload': payload,
+                          'created_at': posix_to_iso8601(timestamp),
+                          })
+        # GitHub keeps the last 300
+        del events[300:]
+
+    def push(self, owner, name, branch_name='master'):
+        '''Move a branch of a repository to a new commit'''
+        repo = self.get_repo(owner, name)
+        repo.push(branch_name)
+        self.add_event(repo, 'PushEvent',
+                       {'ref': 'refs/heads/' + branch_name,
+                        'head': repo.branches[branch_name]},
+                       timestamp=repo.pushed_at)
+
+    def create_tag(self, owner, name, tag_name):
+        '''Tag a new commit of a repository'''
+        repo = self.get_repo(owner, name)
+        repo.pushed_at = max(time.time(), repo.pushed_at + 1)
+        repo.add_tag(tag_name, repo.pushed_at)
+        self.add_event(repo, 'CreateEvent',
+                       {'ref': tag_name, 'ref_type': 'tag'},
+                       timestamp=repo.pushed_at)
+
+    def make_app(self):
+        app = web.Application(middlewares=[self._middleware])
+        router = app.router
+        router.add_post('/graphql', self.graphql)
+        router.add_get('/users/{owner}/repos', self.owner_repos)
+        router.add_get('/orgs/{owner}/repos', self.owner_repos)
+        router.add_get('/users/{owner}/events', self.owner_events)
+        router.add_get('/orgs/{owner}/events', self.owner_events)
+        router.add_get('/repos/{owner}/{repo}/tags', self.tags)
+        router.add_get('/repos/{owner}/{repo}/branches', self.branches)
+        router.add_get('/repos/{owner}/{repo}/branches/{branch}',
+                       self.branch)
+        router.add_get('/repos/{owner}/{repo}/git/commits/{sha}',
+                       self.commit)
+        router.add_get('/repos/{owner}/{repo}/git/trees/{sha}', self.tree)
+        router.add_get('/repos/{owner}/{repo}/git/blobs/{sha}', self.blob)
+        return app
+
+    async def start(self, host='127.0.0.1', port=0):
+        '''Start serving, returning the base URL of the API'''
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        return 'http://{}:{}'.format(host, port)
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+        self.request_count += 1
+        resource = request.match_info.route.resource
+        self.requests_by_endpoint[resource.canonical if resource else '?'] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return await handler(request)
+
+    def _rate_limit_headers(self, resource='core'):
+        now = time.time()
+        if now >= self._rate_limit_reset:
+            self._rate_limit_remaining = self.rate_limit
+            self._graphql_remaining = self.rate_limit
+            self._rate_limit_reset = now + 3600
+        remaining = (self._graphql_remaining if resource == 'graphql'
+                     else self._rate_limit_remaining)
+        return {'X-RateLimit-Limit': str(self.rate_limit),
+                'X-RateLimit-Remaining': str(remaining),
+                'X-RateLimit-Reset': str(int(self._rate_limit_reset)),
+                'X-RateLimit-Resource': resource,
+                }
+
+    def _respond(self, request, value, headers=None):
+        '''Respond with JSON, or 304 if the client has it already'''
+        body = json.dumps(value).encode('utf-8')
+        etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+        headers = dict(headers or {}, ETag=etag)
+
+        if request.headers.get('If-None-Match') == etag:
+            self.not_modified_count += 1
+            headers.update(self._rate_limit_headers())
+            return web.Response(status=304, headers=headers)
+
+        headers.update(self._rate_limit_headers())
+        if self._rate_limit_remaining <= 0:
+            headers['X-RateLimit-Remaining'] = '0'
+            return web.json_response(
+                {'message': 'API rate limit exceeded'}, status=403,
+                headers=headers)
+
+        self._rate_limit_remaining -= 1
+        headers['X-RateLimit-Remaining'] = str(self._rate_limit_remaining)
+        return web.Response(body=body, headers=headers,
+                            content_type='application/json')
+
+    def _respond_page(self, request, items):
+        query = request.rel_url.query
+        per_page = min(int(query.get('per_page', 30)), self.max_page_size)
+        page = max(int(query.get('page', 1)), 1)
+        last_page = max((len(items) + per_page - 1) // per_page, 1)
+
+        links = []
+        if page < last_page:
+            links.append('<{}>; rel="next"'.format(
+                request.url.update_query(page=page + 1)))
+            links.append('<{}>; rel="last"'.format(
+                request.url.update_query(page=last_page)))
+        headers = ({'Link': ', '.join(links)} if links else None)
+        start = (page - 1) * per_page
+        return self._respond(request, items[start:start + per_page], headers)
+
+    def _get_repo(self, request):
+        owner = request.match_info['owner']
+        name = request.match_info['repo']
+        if name not in self.get_repo_names(owner):
+            raise web.HTTPNotFound(text=json.dumps({'message': 'Not Found'}),
+                                   content_type='application/json')
+        return self.get_repo(owner, name)
+
+    async def owner_repos(self, request):
+        owner = request.match_info['owner']
+        repos = [self.get_repo(owner, name).to_json()
+                 for name in self.get_repo_names(owner)]
+        return self._respond_page(request, repos)
+
+    async def owner_events(self, request):
+        owner = request.match_info['owner']
+        per_page = min(int(request.rel_url.query.get('per_page', 30)),
+                       self.max_page_size)
+        return self._respond(request, self.events[owner][:per_page],
+                             {'X-Poll-Interval': str(self.poll_interval)})
+
+    async def tags(self, request):
+        repo = self._get_repo(request)
+        return self._respond_page(request, [
+            {'name': tag['name'], 'commit': {'sha': tag['sha']}}
+            for tag in repo.tags])
+
+    async def branches(self, request):
+        repo = self._get_repo(request)
+        return self._respond_page(request, [
+            {'name': branch_name, 'commit': {'sha': sha}}
+            for branch_name, sha in sorted(repo.branches.items())])
+
+    async def branch(self, request):
+        repo = self._get_repo(request)
+        branch_name = request.match_info['branch']
+        try:
+            sha = repo.branches[branch_name]
+        except KeyError:
+            raise web.HTTPNotFound()
+
+        commit = repo.commits[sha]
+        return self._respond(request, {
+            'name': branch_name,
+            'commit': {'sha': sha,
+                       'commit': {'author': {'date': commit['date']}}},
+        })
+
+    async def commit(self, request):
+        repo = self._get_repo(request)
+        try:
+            commit = repo.commits[request.match_info['sha']]
+        except KeyError:
+            raise web.HTTPNotFound()
+
+        return self._respond(request, {'sha': commit['sha'],
+                                       'author': {'date': commit['date']},
+                                       'tree': {'sha': commit['tree']},
+                                       })
+
+    async def tree(self, request):
+        repo = self._get_repo(request)
+        sha = request.match_info['sha']
+        try:
+            entries = repo.trees[sha]
+        except KeyError:
+            raise web.HTTPNotFound()
+
+        return self._respond(request, {'sha': sha, 'tree': entries,
+                                       'truncated': False})
+
+    async def blob(self, request):
+        repo = self._get_repo(request)
+        sha = request.match_info['sha']
+        try:
+            data = repo.blobs[sha]
+        except KeyError:
+            raise web.HTTPNotFound()
+
+        return self._respond(request, {
+            'sha': sha, 'size': len(data), 'encoding': 'base64',
+            'content': base64.b64encode(data).decode('ascii')})
+
+    async def graphql(self, request):
+        body = await request.json()
+        variables = body.get('variables') or {}
+        self._graphql_remaining = max(self._graphql_remaining - 1, 0)
+        headers = self._rate_limit_headers('graphql')
+        if 'refs(' not in body.get('query', ''):
+            return web.json_response(
+                {'errors': [{'message': 'unsupported query'}]},
+                headers=headers)
+
+        if variables['name'] not in self.get_repo_names(variables['owner']):
+            return web.json_response(
+                {'data': {'repository': None},
+                 'errors': [{'type': 'NOT_FOUND',
+                             'message': 'Could not resolve to a Repository'}]},
+                headers=headers)
+
+        repo = self.get_repo(variables['owner'], variables['name'])
+        start = int(variables.get('cursor') or 0)
+        end = start + self.max_page_size
+        nodes = [repo.tag_ref_node(tag) for tag in repo.tags[start:end]]
+        refs = {'nodes': nodes,
+                'pageInfo': {'hasNextPage': end < len(repo.tags),
+                             'endCursor': str(end)},
+                }
+        return web.json_response({'data': {'repository': {'refs': refs}}},
+                                 headers=headers)
+
+
+def main(port, **kwargs):
+    web.run_app(MockGithub(**kwargs).make_app(), host='127.0.0.1', port=port)
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__, version='0.1')
+
+    if args['-v']:
+        for loggername in ('gitfuse', '__main__'):
+            logging.getLogger(loggername).setLevel(logging.DEBUG)
+        logging.basicConfig()
+
+    main(port=int(args['--port']),
+         num_repos=int(args['--repos']),
+         num_tags=int(args['--tags']),
+         num_branches=int(args['--branches']),
+         latency=float(args['--latency']),
+         rate_limit=int(args['--rate-limit']))
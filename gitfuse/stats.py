@@ -0,0 +1,158 @@
+import time
+import functools
+import collections
+
+
+# name -> OperationStats of each instrumented FUSE callback
+operations = collections.OrderedDict()
+
+
+class Histogram:
+    '''Counts of values in power-of-two buckets of microseconds
+
+    Bucket i holds values below 2**i microseconds (and at least half that),
+    so recording a value is one multiplication and a bit_length().  Updates
+    are not locked: under heavy contention, an occasional count may be lost.
+    '''
+    num_buckets = 32
+
+    def __init__(self):
+        self.counts = [0] * self.num_buckets
+        self.total = 0.0
+
+    def observe(self, seconds):
+        index = int(seconds * 1e6).bit_length()
+        self.counts[min(index, self.num_buckets - 1)] += 1
+        self.total += seconds
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    @staticmethod
+    def upper_bound(index):
+        '''Upper bound of a bucket, in seconds'''
+        return (1 << index) * 1e-6
+
+    def quantile(self, fraction):
+        '''Upper bound of the bucket holding the given quantile'''
+        counts = list(self.counts)
+        target = fraction * sum(counts)
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if count and seen >= target:
+                return self.upper_bound(index)
+        return 0.0
+
+
+class OperationStats:
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.errors = 0
+        self.latency = Histogram()
+
+    def observe(self, seconds, error=False):
+        self.calls += 1
+        if error:
+            self.errors += 1
+        self.latency.observe(seconds)
+
+    def get_statistics(self):
+        latency = self.latency
+        return dict(calls=self.calls,
+                    errors=self.errors,
+                    mean=(latency.total / self.calls if self.calls else 0.0),
+                    p50=latency.quantile(0.5),
+                    p99=latency.quantile(0.99),
+                    histogram={'{:g}'.format(latency.upper_bound(index)): count
+                               for index, count in enumerate(latency.counts)
+                               if count},
+                    )
+
+
+def get_operation(name):
+    try:
+        return operations[name]
+    except KeyError:
+        return operations.setdefault(name, OperationStats(name))
+
+
+def instrument(name):
+    '''Count calls of a FUSE callback, timed from the call to its reply
+
+    The filesystem looks up the start time in `_pending` by request when it
+    replies, which may be from another thread.  A callback that raises may
+    not reply at all, so it is counted as an error then.
+    '''
+    op = get_operation(name)
+
+    def wrapper(func):
+        @functools.wraps(func)
+        def wrapped(self, req, *args):
+            self._pending[req] = (op, time.perf_counter())
+            try:
+                return func(self, req, *args)
+            except BaseException:
+                self._replied(req, error=True)
+                raise
+        return wrapped
+    return wrapper
+
+
+def get_statistics():
+    return {name: op.get_statistics() for name, op in operations.items()}
+
+
+def _prometheus_name(*parts):
+    return '_'.join(str(part) for part in parts if part).replace('-', '_')
+
+
+def _flatten(prefix, value):
+    if isinstance(value, dict):
+        for key, item in value.items():
+            yield from _flatten(_prometheus_name(prefix, key), item)
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        yield prefix, value
+
+
+def to_prometheus(statistics, prefix='gitfuse'):
+    '''Format statistics in the Prometheus text exposition format
+
+    Operations are given as counters and histograms; every other number,
+    at any depth of nesting, as a gauge named by its path.
+    '''
+    lines = []
+    metric = _prometheus_name(prefix, 'operation')
+    lines.append('# TYPE {}_calls_total counter'.format(metric))
+    lines.append('# TYPE {}_errors_total counter'.format(metric))
+    lines.append('# TYPE {}_latency_seconds histogram'.format(metric))
+    for name, op in list(operations.items()):
+        label = 'op="{}"'.format(name)
+        lines.append('{}_calls_total{{{}}} {}'.format(metric, label,
+                                                      op.calls))
+        lines.append('{}_errors_total{{{}}} {}'.format(metric, label,
+                                                       op.errors))
+        cumulative = 0
+        counts = list(op.latency.counts)
+        for index, count in enumerate(counts[:-1]):
+            cumulative += count
+            lines.append('{}_latency_seconds_bucket{{{},le="{:g}"}} {}'
+                         ''.format(metric, label,
+                                   op.latency.upper_bound(index),
+                                   cumulative))
+        lines.append('{}_latency_seconds_bucket{{{},le="+Inf"}} {}'
+                     ''.format(metric, label, sum(counts)))
+        lines.append('{}_latency_seconds_sum{{{}}} {}'.format(
+            metric, label, op.latency.total))
+        lines.append('{}_latency_seconds_count{{{}}} {}'.format(
+            metric, label, sum(counts)))
+
+    for key, value in statistics.items():
+        if key == 'operations':
+            continue
+        for name, number in _flatten(_prometheus_name(prefix, key), value):
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.append('{} {}'.format(name, number))
+    return '\n'.join(lines) + '\n'
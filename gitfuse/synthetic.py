@@ -0,0 +1,155 @@
+'''
+A filesystem of generated directory trees, for load testing
+
+Every directory down to --depth levels holds --dirs subdirectories,
+--files files of --file-size bytes and --links symlinks to those files.
+Directories are generated when first listed unless --eager is given, in
+which case the whole tree is built at mount time.  The number of inodes is
+about (dirs ** depth) * (files + links).
+
+Usage:
+  synthetic.py [-v] <mount_point> [--depth=<n>] [--dirs=<n>] [--files=<n>]
+               [--links=<n>] [--file-size=<bytes>] [--eager]
+               [--workers=<n>]
+
+Options:
+  --depth=<n>           levels of directories [default: 4].
+  --dirs=<n>            subdirectories of each directory [default: 10].
+  --files=<n>           files in each directory [default: 100].
+  --links=<n>           symlinks in each directory [default: 10].
+  --file-size=<bytes>   size of each file [default: 4096].
+  --eager               generate the whole tree up front.
+  --workers=<n>         threads serving FUSE requests, or 0 to serve them
+                        on the session thread [default: 8].
+'''
+
+import logging
+
+from .fs import FileSystem
+from .directory_entry import DirectoryEntry
+
+
+logger = logging.getLogger(__name__)
+
+
+class SyntheticFile:
+    '''File contents generated from a repeating pattern
+
+    Reads return slices of one pattern buffer shared by all files, so
+    files of any size take no memory of their own.
+    '''
+    __slots__ = ('size', 'offset')
+
+    period = 4096
+    _pattern = memoryview(bytearray())
+
+    def __init__(self, size, offset=0):
+        self.size = size
+        # where in the pattern the file starts, so files differ
+        self.offset = offset % self.period
+
+    def __len__(self):
+        return self.size
+
+    @classmethod
+    def _get_pattern(cls, length):
+        if len(cls._pattern) < length:
+            # the pattern repeats every `period` bytes, so any slice of up
+            # to `length` bytes can start within the first period
+            repeats = (length + 2 * cls.period - 1) // cls.period
+            block = bytes(i % 251 for i in range(cls.period))
+            cls._pattern = memoryview(bytearray(block * repeats))
+        return cls._pattern
+
+    def read(self, size, offset):
+        size = max(min(size, self.size - offset), 0)
+        start = (self.offset + offset) % self.period
+        return self._get_pattern(size)[start:start + size]
+
+
+class SyntheticDirectory(DirectoryEntry):
+    '''A directory whose entries are generated on first listing'''
+    def __init__(self, *args, depth=4, num_dirs=10, num_files=100,
+                 num_links=10, file_size=4096, **kwargs):
+        self.depth = depth
+        self.num_dirs = num_dirs
+        self.num_files = num_files
+        self.num_links = num_links
+        self.file_size = file_size
+        self._initialized = False
+        super().__init__(*args, **kwargs)
+
+    def ensure_loaded(self):
+        # concurrent lookups wait for the one generating the directory
+        with self.lock:
+            if not self._initialized:
+                self.generate()
+        return None
+
+    def unload(self):
+        with self.lock:
+            if not self._initialized or self.is_referenced():
+                return False
+
+            self._initialized = False
+            self.clear()
+            return True
+
+    def generate(self, *, recursive=False):
+        self._initialized = True
+        if self.depth > 0:
+            for i in range(self.num_dirs):
+                name = 'dir{}'.format(i)
+                subdir = SyntheticDirectory(
+                    self.fuse, self.inode, name=name, depth=self.depth - 1,
+                    num_dirs=self.num_dirs, num_files=self.num_files,
+                    num_links=self.num_links, file_size=self.file_size,
+                    timestamp=self.entry.mtime)
+                self.add_dir(name, dirobj=subdir)
+                if recursive:
+                    subdir.generate(recursive=True)
+
+        for i in range(self.num_files):
+            self.add_file('file{}'.format(i),
+                          obj=SyntheticFile(self.file_size, self.inode + i))
+
+        for i in range(min(self.num_links, self.num_files)):
+            self.add_link('link{}'.format(i), 'file{}'.format(i))
+
+
+class SyntheticFileSystem(FileSystem):
+    def __init__(self, mount_point, *, eager=False, **kwargs):
+        self.tree_options = {key: kwargs.pop(key)
+                             for key in ('depth', 'num_dirs', 'num_files',
+                                         'num_links', 'file_size')
+                             if key in kwargs}
+        self.eager = eager
+        super().__init__(mount_point, **kwargs)
+
+    def init(self, userdata, conn):
+        super().init(userdata, conn)
+        tree = SyntheticDirectory(self, self.root.inode, name='tree',
+                                  **self.tree_options)
+        self.root.add_dir('tree', dirobj=tree)
+        if self.eager:
+            tree.generate(recursive=True)
+            logger.info('Generated %d inodes', len(self.inode_entries))
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+    args = docopt(__doc__, version='0.1')
+
+    if args['-v']:
+        for loggername in ('gitfuse', '__main__'):
+            logging.getLogger(loggername).setLevel(logging.DEBUG)
+        logging.basicConfig()
+
+    SyntheticFileSystem(args['<mount_point>'],
+                        depth=int(args['--depth']),
+                        num_dirs=int(args['--dirs']),
+                        num_files=int(args['--files']),
+                        num_links=int(args['--links']),
+                        file_size=int(args['--file-size']),
+                        eager=args['--eager'],
+                        workers=int(args['--workers']))
@@ -0,0 +1,129 @@
+import sys
+import time
+import types
+import ctypes
+import asyncio
+import threading
+
+import pytest
+
+
+def _make_fusell():
+    '''A stand-in for the fusell bindings, enough to build unmounted trees'''
+    fusell = types.ModuleType('fusell')
+
+    class fuse_file_info(ctypes.Structure):
+        _fields_ = [('flags', ctypes.c_int),
+                    ('fh_old', ctypes.c_ulong),
+                    ('writepage', ctypes.c_int),
+                    ('direct_io', ctypes.c_uint, 1),
+                    ('keep_cache', ctypes.c_uint, 1),
+                    ('flush', ctypes.c_uint, 1),
+                    ('nonseekable', ctypes.c_uint, 1),
+                    ('padding', ctypes.c_uint, 28),
+                    ('fh', ctypes.c_uint64),
+                    ('lock_owner', ctypes.c_uint64)]
+
+    class FUSELL:
+        '''Records replies in `replies` instead of sending them'''
+        def __init__(self, mountpoint, **kwargs):
+            raise RuntimeError('fusell is not installed; cannot mount')
+
+        def _reply(self, *args):
+            self.__dict__.setdefault('replies', []).append(args)
+
+        def reply_err(self, req, err):
+            self._reply('err', req, err)
+
+        def reply_none(self, req):
+            self._reply('none', req)
+
+        def reply_entry(self, req, entry):
+            self._reply('entry', req, entry)
+
+        def reply_attr(self, req, attr, attr_timeout):
+            self._reply('attr', req, attr, attr_timeout)
+
+        def reply_readlink(self, req, link):
+            self._reply('readlink', req, link)
+
+        def reply_buf(self, req, buf):
+            self._reply('buf', req, bytes(buf))
+
+    fusell.FUSELL = FUSELL
+    fusell.fuse_file_info = fuse_file_info
+    return fusell
+
+
+try:
+    import fusell  # noqa
+except ImportError:
+    sys.modules['fusell'] = _make_fusell()
+
+
+from gitfuse import cache, ghclient  # noqa: E402
+from gitfuse.blobstore import BlobStore  # noqa: E402
+from gitfuse.githubfs import GithubFileSystem  # noqa: E402
+from gitfuse.mock_github import MockGithub  # noqa: E402
+
+
+class RecordingLibFuse:
+    '''Records the replies FileSystem sends to libfuse directly'''
+    def __init__(self):
+        self.replies = []
+
+    def fuse_reply_open(self, req, info):
+        self.replies.append(('open', req, info._obj.fh))
+
+    def fuse_reply_buf(self, req, buf, size):
+        self.replies.append(('buf', req, ctypes.string_at(buf, size)))
+
+    def wait(self, count=1, timeout=5.0):
+        '''Wait for `count` replies, which may be sent from other threads'''
+        deadline = time.monotonic() + timeout
+        while len(self.replies) < count and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.replies
+
+
+@pytest.fixture
+def libfuse():
+    '''Stands in for libfuse; assign to a filesystem's `_libfuse`'''
+    return RecordingLibFuse()
+
+
+@pytest.fixture
+def github(tmp_path):
+    '''A MockGithub served from its own thread, with empty caches'''
+    mock = MockGithub(num_repos=5, num_tags=3, num_branches=3)
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    saved = (ghclient.api_url, ghclient.use_graphql, cache.backend)
+    ghclient.api_url = asyncio.run_coroutine_threadsafe(mock.start(),
+                                                        loop).result()
+    ghclient.use_graphql = False
+    cache.set_backend(cache.SQLiteBackend(str(tmp_path / 'cache.db'),
+                                          migrate_from={}))
+    try:
+        yield mock
+    finally:
+        ghclient.api_url, ghclient.use_graphql, backend = saved
+        cache.set_backend(backend)
+        asyncio.run_coroutine_threadsafe(mock.stop(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+@pytest.fixture
+def githubfs(github, tmp_path):
+    '''An unmounted GithubFileSystem of the mock's organization "org"'''
+    fs = GithubFileSystem(None, organizations=['org'], mount=False,
+                          auto_update=False,
+                          blob_store=BlobStore(str(tmp_path / 'blobs')))
+    try:
+        yield fs
+    finally:
+        fs.destroy(None)
@@ -0,0 +1,42 @@
+import os
+import hashlib
+
+import pytest
+
+from gitfuse.blobstore import BlobStore
+
+
+def _sha(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+def test_put_and_read(tmp_path):
+    store = BlobStore(str(tmp_path))
+    data = b'0123456789'
+    store.put(_sha(data), data)
+    assert _sha(data) in store
+    assert bytes(store.read(_sha(data), 4, 2)) == b'2345'
+    assert store.read(_sha(data), 4, 20) == b''
+
+    # found again on disk
+    assert _sha(data) in BlobStore(str(tmp_path))
+
+
+def test_eviction(tmp_path):
+    store = BlobStore(str(tmp_path), max_bytes=25)
+    blobs = [bytes([i]) * 10 for i in range(3)]
+    store.put(_sha(blobs[0]), blobs[0])
+    store.put(_sha(blobs[1]), blobs[1])
+    store.read(_sha(blobs[0]), 10, 0)
+    store.put(_sha(blobs[2]), blobs[2])
+
+    # the least recently read blob is removed, from disk too
+    assert _sha(blobs[1]) not in store
+    assert not os.path.exists(store._blob_path(_sha(blobs[1])))
+    assert _sha(blobs[0]) in store and _sha(blobs[2]) in store
+    assert store.total_bytes == 20
+    assert store.evictions == 1
+
+    with pytest.raises(KeyError):
+        store.read(_sha(blobs[1]), 10, 0)
+    assert store.misses == 1
@@ -0,0 +1,95 @@
+import json
+import time
+
+from gitfuse import cache, ghclient
+from gitfuse.cache import SQLiteBackend, TaggedCache
+
+
+def test_sqlite_backend(tmp_path):
+    fn = str(tmp_path / 'cache.db')
+    backend = SQLiteBackend(fn, migrate_from={})
+    backend.set('tags', 'key', dict(etag='"1"'), [1, 2])
+    backend.set('tags', 'other', None, 'value')
+    backend.set_tag('tags', 'key', dict(etag='"2"'))
+    backend.delete('tags', 'other')
+    backend.close()
+
+    # written as soon as set, and read on demand
+    backend = SQLiteBackend(fn, migrate_from={})
+    assert backend.get('tags', 'key') == (dict(etag='"2"'), [1, 2])
+    assert backend.get('tags', 'other') is None
+    assert backend.get('branches', 'key') is None
+    backend.close()
+
+
+def _write_json_cache(fn, entries):
+    with open(fn, 'wt') as f:
+        json.dump({'tags': {key: tag for key, (tag, value) in entries.items()},
+                   'data': {key: value
+                            for key, (tag, value) in entries.items()}}, f)
+
+
+def test_migrate_json(github, githubfs, tmp_path):
+    sha = 'a' * 40
+    commit = {'sha': sha, 'author': {'date': '2020-01-01T00:00:00Z'}}
+    tags = [{'name': 'v0.1', 'commit': {'sha': sha}}]
+    # as cached by the earliest versions: listings as a single page, tags
+    # and branches tagged by the time they were fetched, commits by URL
+    _write_json_cache(str(tmp_path / 'tags.json'), {
+        'repos/org/repo0000/tags': (time.time(), tags),
+        'garbage': (0.0, None),
+    })
+    _write_json_cache(str(tmp_path / 'commits.json'), {
+        'repos/org/repo0000/git/commits/' + sha: (time.time(), commit),
+    })
+
+    backend = SQLiteBackend(str(tmp_path / 'migrated.db'),
+                            migrate_from={'tags': str(tmp_path / 'tags.json'),
+                                          'commits': str(tmp_path /
+                                                         'commits.json')})
+    cache.set_backend(backend)
+    backend.conn
+    assert (tmp_path / 'tags.json.migrated').exists()
+    assert backend.get('tags', 'garbage') is None
+
+    requests = github.request_count
+    _, cached_tags = githubfs.run(ghclient.get_tags(
+        'org', 'repo0000', session=githubfs.session))
+    _, cached_commit = githubfs.run(ghclient.get_commit_info(
+        'org', 'repo0000', sha, session=githubfs.session))
+    assert cached_tags == tags
+    assert cached_commit == commit
+    assert github.request_count == requests
+
+
+def test_lru_eviction(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / 'cache.db'), migrate_from={})
+    tagged = TaggedCache('tags', backend, max_entries=2)
+    for key in 'abc':
+        tagged.set_with_tag(key, None, key.upper())
+    assert len(tagged) == 2
+    assert tagged.evictions == 1
+
+    # evicted from memory, but read back from the backend
+    assert tagged['a'] == 'A'
+    assert (tagged.hits, tagged.misses) == (0, 1)
+    assert tagged['a'] == 'A'
+    assert (tagged.hits, tagged.misses) == (1, 1)
+    # 'b' was least recently used
+    assert 'b' not in tagged._data
+    backend.close()
+
+
+def test_ttl_eviction(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, 'monotonic', lambda: now[0])
+    tagged = TaggedCache('tags', ttl=10.0)
+    tagged.set_with_tag('a', None, 1)
+    now[0] += 5
+    assert tagged['a'] == 1
+
+    # without a backend, an idle entry is gone for good
+    now[0] += 11
+    assert tagged.get('a') is None
+    assert tagged.get_statistics() == dict(entries=0, hits=1, misses=1,
+                                           evictions=1)
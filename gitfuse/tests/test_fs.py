@@ -0,0 +1,151 @@
+import json
+import ctypes
+import struct
+import threading
+
+import fusell
+import pytest
+
+from gitfuse import fs as fs_module
+from gitfuse.dirbuf import DirectoryListing
+from gitfuse.fs import FileSystem
+
+
+@pytest.fixture
+def fs():
+    fs = FileSystem(None, mount=False)
+    try:
+        yield fs
+    finally:
+        fs.destroy(None)
+
+
+def _names(buf):
+    names = []
+    while buf:
+        ino, off, namelen, type_ = struct.unpack_from('=QQII', buf)
+        names.append(buf[24:24 + namelen].decode())
+        size = 24 + namelen
+        buf = buf[size + (-size % 8):]
+    return names, off
+
+
+def test_listing_chunks():
+    entries = [('file{}'.format(i), dict(st_ino=i + 2, st_mode=0o100444))
+               for i in range(100)]
+    listing = DirectoryListing(0, entries)
+    names = []
+    off = 0
+    while True:
+        buf = listing.read(off, 256)
+        if not buf:
+            break
+        assert len(buf) <= 256
+        chunk, off = _names(buf)
+        names.extend(chunk)
+    assert names == [name for name, _ in entries]
+
+
+def test_listing_rebuilt_on_change(fs):
+    tree = fs.root.add_dir('tree').obj
+    tree.add_file('a', obj=b'')
+    listing = fs.get_listing(tree)
+    assert fs.get_listing(tree) is listing
+
+    tree.add_file('b', obj=b'')
+    names, _ = _names(fs.get_listing(tree).read(0, 4096))
+    assert names == ['.', '..', 'a', 'b']
+
+
+def test_forget_multi(fs):
+    fs._add_lookup(5)
+    fs._add_lookup(5)
+    fs._add_lookup(6)
+    forgets = (fs_module.fuse_forget_data * 2)((5, 1), (6, 1))
+    fs.fuse_forget_multi('req', 2, forgets)
+    assert fs.lookup_counts == {5: 1}
+    assert fs.replies[-1] == ('none', 'req')
+
+
+def test_generated_file_snapshot(fs, libfuse):
+    ino = fs.root['.gitfuse'].obj['stats'].inode
+    fs._libfuse = libfuse
+
+    fi = ctypes.pointer(fusell.fuse_file_info())
+    fs.open('open', ino, fi)
+    assert fi.contents.direct_io
+    assert libfuse.replies == [('open', 'open', fi.contents.fh)]
+
+    size = fs.inode_entries[ino].stat()['st_size']
+    assert size > 0
+    # stat and other requests in between change nothing that is read
+    fs.getattr('getattr', ino, None)
+    assert fs.inode_entries[ino].stat()['st_size'] == size
+
+    fs.read('read', ino, 1 << 20, 0, fi)
+    _, req, data = libfuse.replies[-1]
+    assert req == 'read'
+    assert len(data) == size
+    # generated at open, while only the open was pending
+    assert json.loads(data.decode())['pending_requests'] == 1
+
+    fs.release('release', ino, fi)
+    assert not fs._handles
+
+
+def test_pending_removed_on_error(fs):
+    fs.inode_entries = None
+    with pytest.raises(TypeError):
+        fs.getattr('req', 1, None)
+    assert not fs._pending
+
+
+def test_concurrent_requests(libfuse):
+    fs = FileSystem(None, mount=False, workers=4)
+    fs._libfuse = libfuse
+    try:
+        tree = fs.root.add_dir('tree').obj
+        for i in range(50):
+            tree.add_file('file{}'.format(i), obj=b'')
+        inodes = [entry.inode for entry in tree.entry_by_name.values()]
+
+        # the directory changes while the workers look up and list it
+        stop = threading.Event()
+
+        def churn():
+            while not stop.is_set():
+                tree.add_file('new', obj=b'')
+                tree.remove('new')
+
+        def send(start):
+            for req in range(start, 600, 4):
+                if req % 3 == 0:
+                    fs.lookup(req, tree.inode, b'new' if req % 2 else
+                              'file{}'.format(req % 50).encode())
+                elif req % 3 == 1:
+                    fs.readdir(req, tree.inode, 4096, 0, None)
+                else:
+                    fs.getattr(req, inodes[req % 50], None)
+
+        threads = [threading.Thread(target=churn)]
+        threads += [threading.Thread(target=send, args=(start, ))
+                    for start in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads[1:]:
+            thread.join()
+        stop.set()
+        threads[0].join()
+
+        fs._workers.shutdown(wait=True)
+        replies = fs.replies + libfuse.replies
+        assert sorted(req for _, req, *_ in replies) == list(range(600))
+        assert not [reply for reply in replies if reply[0] == 'err']
+        assert not fs._pending
+
+        for kind, req, *args in replies:
+            if kind == 'buf':
+                names, _ = _names(args[0])
+                assert set(names) >= {'file{}'.format(i) for i in range(50)}
+    finally:
+        fs.destroy(None)
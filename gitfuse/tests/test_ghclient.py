@@ -0,0 +1,179 @@
+import time
+import asyncio
+
+import pytest
+
+from gitfuse import ghclient
+from gitfuse.ghclient import (RequestScheduler, SingleFlight, GraphQLError,
+                              INTERACTIVE, BACKGROUND)
+
+
+class _Response:
+    def __init__(self, limit, remaining, reset):
+        self.rate_limit = limit
+        self.rate_limit_remaining = remaining
+        self.rate_limit_reset = reset
+        self.rate_limit_resource = 'core'
+        self.rate_limited = False
+
+
+def test_scheduler_reserve():
+    scheduler = RequestScheduler()
+    assert scheduler.reserve == 500
+
+    reset = time.time() + 3600
+    scheduler.update_rate_limit(_Response(5000, 4000, reset))
+    assert scheduler.reserve == 500
+
+    # unauthenticated: 10% of 60 requests an hour
+    scheduler.update_rate_limit(_Response(60, 10, reset))
+    assert scheduler.reserve == 6
+    assert scheduler.quota_delay(BACKGROUND) == 0.0
+
+    scheduler.update_rate_limit(_Response(60, 6, reset))
+    assert scheduler.quota_delay(BACKGROUND) > 0
+    assert scheduler.quota_delay(INTERACTIVE) == 0.0
+
+    scheduler.update_rate_limit(_Response(60, 0, reset))
+    assert scheduler.quota_delay(INTERACTIVE) > 0
+
+
+def test_scheduler_priority():
+    async def run():
+        scheduler = RequestScheduler(max_concurrency=1)
+        order = []
+
+        async def request(name, priority):
+            await scheduler.acquire(priority)
+            order.append(name)
+            await asyncio.sleep(0)
+            scheduler.release()
+
+        await scheduler.acquire(BACKGROUND)
+        waiting = [asyncio.ensure_future(request('background', BACKGROUND)),
+                   asyncio.ensure_future(request('interactive', INTERACTIVE))]
+        await asyncio.sleep(0)
+        scheduler.release()
+        await asyncio.gather(*waiting)
+        return order
+
+    assert asyncio.run(run()) == ['interactive', 'background']
+
+
+def _list_repos(fs):
+    ghclient.expire_repos('org', org=True)
+    _, repos = fs.run(ghclient.get_org_repos('org', session=fs.session))
+    return repos
+
+
+def test_pagination_follows_grown_listing(github, githubfs):
+    github.owner_sizes['org'] = 200
+    assert len(_list_repos(githubfs)) == 200
+    github.owner_sizes['org'] = 250
+    assert len(_list_repos(githubfs)) == 250
+    github.owner_sizes['org'] = 120
+    assert len(_list_repos(githubfs)) == 120
+
+
+def test_pagination_exact_multiple(github, githubfs):
+    github.owner_sizes['org'] = 200
+    cache = ghclient.caches['org-repo']
+    for _ in range(3):
+        requests = github.request_count
+        assert len(_list_repos(githubfs)) == 200
+        # two full pages, and no request for an empty third
+        assert github.request_count - requests == 2
+        assert ghclient._page_key('org', 2) in cache
+        assert ghclient._page_key('org', 3) not in cache
+
+
+def test_graphql_tag_commits(github, githubfs, monkeypatch):
+    monkeypatch.setattr(ghclient, 'use_graphql', True)
+    _, rest_tags = githubfs.run(ghclient.get_tags('org', 'repo0000',
+                                                  session=githubfs.session))
+    tags = githubfs.run(ghclient.get_tag_commits('org', 'repo0000',
+                                                 session=githubfs.session))
+    assert ([(name, sha) for name, sha, _ in tags] ==
+            [(tag['name'], tag['commit']['sha']) for tag in rest_tags])
+    assert all(info['author']['date'] for _, _, info in tags)
+    assert github.requests_by_endpoint['/graphql'] == 1
+    assert not github.requests_by_endpoint[
+        '/repos/{owner}/{repo}/git/commits/{sha}']
+
+
+def test_graphql_missing_repository(github, githubfs, monkeypatch):
+    monkeypatch.setattr(ghclient, 'use_graphql', True)
+    with pytest.raises(GraphQLError) as excinfo:
+        githubfs.run(ghclient.get_tag_commits('org', 'missing',
+                                              session=githubfs.session))
+    assert excinfo.value.status == 404
+
+
+def test_graphql_rate_limit_is_separate(github, githubfs, monkeypatch):
+    monkeypatch.setattr(ghclient, 'use_graphql', True)
+    githubfs.run(ghclient.get_tags('org', 'repo0000',
+                                   session=githubfs.session))
+    remaining = ghclient.scheduler.rate_limit_remaining
+    assert remaining == github._rate_limit_remaining
+
+    # an almost spent GraphQL budget does not hold back REST requests
+    github._graphql_remaining = 2
+    githubfs.run(ghclient.get_tag_commits('org', 'repo0000',
+                                          session=githubfs.session))
+    assert ghclient.scheduler.rate_limit_remaining == remaining
+
+
+def test_conditional_requests(github, githubfs):
+    _, tags = githubfs.run(ghclient.get_tags('org', 'repo0000',
+                                             session=githubfs.session))
+    assert len(tags) == 3
+
+    not_modified = github.not_modified_count
+    ghclient.expire_tags('org', 'repo0000')
+    _, cached_tags = githubfs.run(ghclient.get_tags('org', 'repo0000',
+                                                    session=githubfs.session))
+    assert cached_tags == tags
+    assert github.not_modified_count == not_modified + 1
+
+
+def test_single_flight_dedup():
+    async def run():
+        single_flight = SingleFlight()
+        calls = []
+
+        async def fetch():
+            calls.append(None)
+            await asyncio.sleep(0.01)
+            return len(calls)
+
+        results = await asyncio.gather(*(single_flight.run('key', fetch)
+                                         for _ in range(5)))
+        return results, calls, len(single_flight)
+
+    results, calls, inflight = asyncio.run(run())
+    assert results == [1] * 5
+    assert len(calls) == 1
+    assert inflight == 0
+
+
+def test_single_flight_interactive_not_held_by_background():
+    async def run():
+        single_flight = SingleFlight()
+
+        async def fetch(name, delay):
+            await asyncio.sleep(delay)
+            return name
+
+        background = asyncio.ensure_future(
+            single_flight.run('key', lambda: fetch('background', 1.0)))
+        await asyncio.sleep(0)
+        t0 = time.monotonic()
+        interactive = await single_flight.run(
+            'key', lambda: fetch('interactive', 0.01), priority=INTERACTIVE)
+        elapsed = time.monotonic() - t0
+        background.cancel()
+        return interactive, elapsed
+
+    result, elapsed = asyncio.run(run())
+    assert result == 'interactive'
+    assert elapsed < 0.5
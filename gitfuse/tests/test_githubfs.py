@@ -0,0 +1,254 @@
+import os
+import time
+import asyncio
+
+import pytest
+
+from gitfuse import ghclient, githubfs as githubfs_module
+from gitfuse.blobstore import BlobStore
+from gitfuse.githubfs import (GithubFileSystem, RestObjectSource,
+                              event_changes, immutable_timeout)
+
+
+def _repo_dir(fs, name='repo0000'):
+    return fs.orgs['org'].obj[name].obj
+
+
+def _load(obj):
+    fut = obj.ensure_loaded()
+    if fut is not None:
+        fut.result()
+    return obj
+
+
+def _contents(blob):
+    return bytes(_load(blob).read(1 << 20, 0))
+
+
+def test_tree_listing(githubfs):
+    githubfs.run(githubfs.update())
+    tag_dir = _load(_repo_dir(githubfs)['tags'].obj)
+    tree = _load(tag_dir['v0.1'].obj)
+    assert sorted(tree.entry_by_name) == ['README', 'README.md', 'src']
+    assert tree['README'].type_ == 'link'
+    assert _contents(tree['README'].obj) == b'README.md'
+    assert _contents(tree['README.md'].obj) == b'org/repo0000 at v0.1\n'
+
+    src = _load(tree['src'].obj)
+    assert len(src.entry_by_name) == 20
+    assert (_contents(src['module0.py'].obj) ==
+            b'# file 0 of org/repo0000\n')
+
+
+def test_branch_moves_while_listing(github, githubfs, monkeypatch):
+    githubfs.run(githubfs.update())
+    branch_dir = _load(_repo_dir(githubfs)['branches'].obj)
+    tree = branch_dir['master'].obj
+
+    get_tree = RestObjectSource.get_tree
+
+    async def slow_get_tree(self, *args, **kwargs):
+        await asyncio.sleep(0.3)
+        return await get_tree(self, *args, **kwargs)
+
+    monkeypatch.setattr(RestObjectSource, 'get_tree', slow_get_tree)
+    listing = tree.ensure_loaded()
+    time.sleep(0.1)
+
+    github.push('org', 'repo0000')
+    ghclient.expire_branches('org', 'repo0000')
+    githubfs.run(branch_dir.update())
+    listing.result()
+
+    # listed at the commit the branch moved to, not the one it left
+    assert tree.initialized
+    assert tree.commit_sha == github.get_repo('org', 'repo0000').branches[
+        'master']
+    assert b'master@' in _contents(tree['README.md'].obj)
+
+
+def test_read_evicted_blob(githubfs, libfuse, monkeypatch):
+    githubfs._libfuse = libfuse
+    githubfs.run(githubfs.update())
+    tree = _load(_load(_repo_dir(githubfs)['tags'].obj)['v0.1'].obj)
+    entry = tree['README.md']
+    _load(entry.obj)
+
+    store = githubfs.blob_store
+    read = store.read
+
+    def evicting_read(sha, size, offset):
+        # evicted by other reads between loading the blob and reading it
+        if sha in store:
+            store.total_bytes -= store._sizes.pop(sha)
+            os.unlink(store._blob_path(sha))
+        monkeypatch.setattr(store, 'read', read)
+        return read(sha, size, offset)
+
+    monkeypatch.setattr(store, 'read', evicting_read)
+    githubfs.read('req', entry.inode, 4096, 0, None)
+    assert libfuse.wait() == [('buf', 'req', b'org/repo0000 at v0.1\n')]
+
+
+def test_forget_unloads(githubfs):
+    githubfs.run(githubfs.update())
+    tag_dir = _load(_repo_dir(githubfs)['tags'].obj)
+    tag = next(iter(tag_dir.entry_by_name.values()))
+    githubfs._add_lookup(tag_dir.inode)
+    githubfs._add_lookup(tag.inode)
+
+    # a directory is kept while the kernel holds an inode below it
+    githubfs.forget('req', tag_dir.inode, 1)
+    assert tag_dir.initialized
+    assert tag.inode in githubfs.inode_entries
+
+    githubfs.forget_multi('req', [(tag.inode, 1)])
+    githubfs._add_lookup(tag_dir.inode)
+    githubfs.forget('req', tag_dir.inode, 1)
+    assert not tag_dir.initialized
+    assert tag.inode not in githubfs.inode_entries
+    assert githubfs.evicted_inodes > 0
+    assert githubfs.replies[-1] == ('none', 'req')
+
+
+def test_unload_during_update(github, githubfs, monkeypatch):
+    githubfs.run(githubfs.update())
+    branch_dir = _load(_repo_dir(githubfs)['branches'].obj)
+    branches = sorted(branch_dir.entry_by_name)
+    github.push('org', 'repo0000')
+    ghclient.expire_branches('org', 'repo0000')
+
+    get_commit_info = githubfs_module.get_commit_info
+
+    async def slow_commit_info(*args, **kwargs):
+        await asyncio.sleep(0.3)
+        return await get_commit_info(*args, **kwargs)
+
+    monkeypatch.setattr(githubfs_module, 'get_commit_info', slow_commit_info)
+    update = githubfs.submit(branch_dir.update())
+    time.sleep(0.1)
+    assert branch_dir.unload()
+    update.result()
+
+    # the update found the directory unloaded and left it for next use
+    assert not branch_dir.initialized
+    assert not branch_dir.entry_by_name
+
+    monkeypatch.setattr(githubfs_module, 'get_commit_info', get_commit_info)
+    assert sorted(_load(branch_dir).entry_by_name) == branches
+
+
+def test_hashed_inodes(githubfs):
+    githubfs.run(githubfs.update())
+    tag_dir = _load(_repo_dir(githubfs)['tags'].obj)
+    inodes = {name: entry.inode
+              for name, entry in tag_dir.entry_by_name.items()}
+    assert all(ino > 0xffffffff for ino in inodes.values())
+    assert all(githubfs.create_ino((tag_dir.inode, name)) == ino
+               for name, ino in inodes.items())
+
+    # the same paths are numbered the same once evicted and listed again
+    assert tag_dir.unload()
+    _load(tag_dir)
+    assert {name: entry.inode
+            for name, entry in tag_dir.entry_by_name.items()} == inodes
+
+
+def test_negative_entries(githubfs):
+    githubfs.run(githubfs.update())
+    tag_dir = _load(_repo_dir(githubfs)['tags'].obj)
+    tree = _load(tag_dir['v0.1'].obj)
+
+    # trees of tags never change, so misses are cached as long as entries
+    githubfs.lookup('req', tree.inode, b'missing')
+    assert githubfs.replies[-1] == ('entry', 'req', dict(
+        ino=0, attr=dict(st_ino=0), attr_timeout=immutable_timeout,
+        entry_timeout=immutable_timeout))
+
+    githubfs.lookup('req', tree.inode, b'README.md')
+    _, _, entry = githubfs.replies[-1]
+    assert entry['ino'] == tree['README.md'].inode
+    assert entry['entry_timeout'] == immutable_timeout
+
+    githubfs.getattr('req', tree['README.md'].inode, None)
+    assert githubfs.replies[-1][-1] == immutable_timeout
+
+    # while a tag yet to be created is only cached until the next refresh
+    githubfs.lookup('req', tag_dir.inode, b'v9.0')
+    _, _, entry = githubfs.replies[-1]
+    assert entry['ino'] == 0
+    assert entry['entry_timeout'] == githubfs.update_rate
+
+
+def test_new_names_invalidated(github, githubfs, monkeypatch):
+    githubfs.run(githubfs.update())
+    tag_dir = _load(_repo_dir(githubfs)['tags'].obj)
+    notified = []
+    monkeypatch.setattr(githubfs, '_notify_inval_entry',
+                        lambda parent, name: notified.append((parent, name)))
+
+    # only directories the kernel holds can have negative entries cached
+    github.create_tag('org', 'repo0000', 'v9.0')
+    ghclient.expire_tags('org', 'repo0000')
+    githubfs.run(tag_dir.update())
+    githubfs._notifier.submit(lambda: None).result()
+    assert notified == []
+
+    githubfs._add_lookup(tag_dir.inode)
+    github.create_tag('org', 'repo0000', 'v9.1')
+    ghclient.expire_tags('org', 'repo0000')
+    githubfs.run(tag_dir.update())
+    githubfs._notifier.submit(lambda: None).result()
+    assert notified == [(tag_dir.inode, 'v9.1')]
+
+
+@pytest.mark.parametrize('event, changes', [
+    (dict(type='PushEvent', payload=dict(ref='refs/heads/master')),
+     {'branches'}),
+    (dict(type='PushEvent', payload=dict(ref='refs/tags/v1.0')), {'tags'}),
+    (dict(type='CreateEvent', payload=dict(ref_type='tag')), {'tags'}),
+    (dict(type='DeleteEvent', payload=dict(ref_type='branch')),
+     {'branches'}),
+    (dict(type='CreateEvent', payload=dict(ref_type='repository')),
+     {'repo'}),
+    (dict(type='ReleaseEvent', payload={}), {'tags'}),
+    (dict(type='PublicEvent', payload=None), {'repo'}),
+    (dict(type='WatchEvent', payload=dict(action='started')), set()),
+])
+def test_event_changes(event, changes):
+    assert event_changes(event) == changes
+
+
+def test_events_refresh(github, tmp_path):
+    fs = GithubFileSystem(None, organizations=['org'], mount=False,
+                          auto_update=False, events=True,
+                          blob_store=BlobStore(str(tmp_path / 'blobs')))
+    try:
+        fs.run(fs.poll_events())
+        fs.run(fs.update())
+        branch_dir = _load(_repo_dir(fs, 'repo0001')['branches'].obj)
+        tag_dir = _load(_repo_dir(fs, 'repo0002')['tags'].obj)
+        sha = branch_dir['master'].obj.commit_sha
+
+        github.push('org', 'repo0001')
+        github.create_tag('org', 'repo0002', 'v9.0')
+        for state in fs._event_state.values():
+            state['next_poll'] = 0.0
+        fs.run(fs.poll_events())
+        assert branch_dir['master'].obj.commit_sha != sha
+        assert 'v9.0' in tag_dir.entry_by_name
+
+        # the next full update does not refresh them again
+        ghclient.expire_repos('org', org=True)
+        refreshed = []
+        update_tags = fs.update_tags
+
+        async def counting_update_tags(repo_dir, repo_owner, repo_name):
+            refreshed.append(repo_name)
+            await update_tags(repo_dir, repo_owner, repo_name)
+
+        fs.update_tags = counting_update_tags
+        fs.run(fs.update())
+        assert refreshed == []
+    finally:
+        fs.destroy(None)
@@ -0,0 +1,90 @@
+import os
+import shutil
+import asyncio
+import subprocess
+
+import pytest
+
+from gitfuse.gitpack import PackRepository, PackError
+from gitfuse.githubfs import PackObjectSource
+
+
+pytestmark = pytest.mark.skipif(shutil.which('git') is None,
+                                reason='git is not installed')
+
+
+def _git(path, *args):
+    env = dict(os.environ, GIT_AUTHOR_NAME='a', GIT_AUTHOR_EMAIL='a@b',
+               GIT_COMMITTER_NAME='a', GIT_COMMITTER_EMAIL='a@b')
+    return subprocess.check_output(('git', '-C', path) + args,
+                                   env=env).decode('ascii').strip()
+
+
+@pytest.fixture
+def remote(tmp_path):
+    '''A bare repository with two commits on master, served over file://'''
+    work = str(tmp_path / 'work')
+    os.makedirs(os.path.join(work, 'src'))
+    _git(str(tmp_path), 'init', '--quiet', '-b', 'master', work)
+    with open(os.path.join(work, 'README.md'), 'wt') as f:
+        f.write('old\n')
+    _git(work, 'add', '-A')
+    _git(work, 'commit', '--quiet', '-m', 'first')
+
+    with open(os.path.join(work, 'README.md'), 'wt') as f:
+        f.write('hello\n')
+    with open(os.path.join(work, 'src', 'module.py'), 'wt') as f:
+        f.write('pass\n')
+    os.symlink('README.md', os.path.join(work, 'README'))
+    _git(work, 'add', '-A')
+    _git(work, 'commit', '--quiet', '-m', 'second')
+
+    bare = str(tmp_path / 'remote.git')
+    _git(str(tmp_path), 'clone', '--quiet', '--bare', work, bare)
+    return 'file://' + bare, _git(work, 'rev-parse', 'HEAD')
+
+
+def test_fetch_and_read(remote, tmp_path):
+    url, sha = remote
+    pack = PackRepository(url, str(tmp_path / 'pack.git'))
+    source = PackObjectSource(pack)
+
+    async def run():
+        try:
+            tree_sha = await source.get_commit_tree('refs/heads/master', sha)
+            tree = {entry['path']: entry
+                    for entry in await source.get_tree(tree_sha)}
+            src = await source.get_tree(tree['src']['sha'])
+            return (tree, src,
+                    await source.get_blob(tree['README.md']['sha']),
+                    await source.get_blob(tree['README']['sha']))
+        finally:
+            await source.close()
+
+    tree, src, readme, link = asyncio.run(run())
+    assert sorted(tree) == ['README', 'README.md', 'src']
+    assert tree['README']['mode'] == '120000'
+    assert tree['README.md']['size'] == 6
+    assert tree['src']['type'] == 'tree'
+    assert [entry['path'] for entry in src] == ['module.py']
+    assert readme == b'hello\n'
+    assert link == b'README.md'
+
+    # a shallow fetch: the parent commit was not transferred
+    assert _git(str(tmp_path / 'pack.git'), 'rev-list', '--count',
+                sha) == '1'
+
+
+def test_missing_object(remote, tmp_path):
+    url, sha = remote
+    pack = PackRepository(url, str(tmp_path / 'pack.git'))
+
+    async def run():
+        try:
+            await pack.fetch('refs/heads/master', sha)
+            with pytest.raises(PackError):
+                await pack.read_blob('0' * 40)
+        finally:
+            await pack.close()
+
+    asyncio.run(run())
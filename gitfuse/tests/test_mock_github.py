@@ -0,0 +1,45 @@
+import json
+import asyncio
+
+import aiohttp
+
+from gitfuse import ghclient
+
+
+def _get(path, headers=None):
+    async def get():
+        async with aiohttp.ClientSession() as session:
+            async with session.get(ghclient.api_url + path,
+                                   headers=headers or {}) as resp:
+                return resp.status, resp.headers, await resp.read()
+    return asyncio.run(get())
+
+
+def test_pages(github):
+    github.owner_sizes['org'] = 150
+    status, headers, body = _get('/orgs/org/repos?per_page=100')
+    assert status == 200
+    assert len(json.loads(body.decode())) == 100
+    assert 'rel="next"' in headers['Link']
+
+    status, headers, body = _get('/orgs/org/repos?per_page=100&page=2')
+    assert len(json.loads(body.decode())) == 50
+    assert 'Link' not in headers
+
+
+def test_not_modified(github):
+    status, headers, _ = _get('/repos/org/repo0000/tags')
+    assert status == 200
+    remaining = int(headers['X-RateLimit-Remaining'])
+
+    status, headers, _ = _get('/repos/org/repo0000/tags',
+                              {'If-None-Match': headers['ETag']})
+    assert status == 304
+    assert github.not_modified_count == 1
+    # conditional requests answered with 304 are free
+    assert int(headers['X-RateLimit-Remaining']) == remaining
+
+
+def test_unknown_repository(github):
+    status, _, _ = _get('/repos/org/missing/tags')
+    assert status == 404
@@ -1,3 +1,61 @@
-from collections import namedtuple
+import os
+import stat
 
-EntryInfo = namedtuple('EntryInfo', 'type_ inode attr name obj')
+
+uid = os.getuid()
+gid = os.getgid()
+
+
+class Inode:
+    '''An entry in the inode table
+
+    Only the fields that differ between entries are stored; the stat dict
+    passed to FUSE is built by `stat` when it is asked for.
+    '''
+    __slots__ = ('inode', 'parent', 'mode', 'nlink', 'size', 'mtime',
+                 'ctime', 'name', 'obj')
+
+    def __init__(self, inode, mode, *, parent=None, nlink=1, size=0,
+                 mtime=0.0, ctime=None, name='', obj=None):
+        self.inode = inode
+        self.parent = parent
+        self.mode = mode
+        self.nlink = nlink
+        self.size = size
+        self.mtime = mtime
+        self.ctime = mtime if ctime is None else ctime
+        self.name = name
+        self.obj = obj
+
+    @property
+    def type_(self):
+        if stat.S_ISDIR(self.mode):
+            return 'dir'
+        elif stat.S_ISLNK(self.mode):
+            return 'link'
+        return 'file'
+
+    def stat(self):
+        return dict(st_ino=self.inode,
+                    st_mode=self.mode,
+                    st_nlink=self.nlink,
+                    st_uid=uid,
+                    st_gid=gid,
+                    st_size=self.size,
+                    st_atime=self.mtime,
+                    st_mtime=self.mtime,
+                    st_ctime=self.ctime,
+                    )
+
+    def __repr__(self):
+        return '<Inode {} {} {!r}>'.format(self.inode, self.type_, self.name)
+
+
+class GeneratedInode(Inode):
+    '''An inode of a file that is generated again whenever it is opened'''
+    __slots__ = ()
+
+    def stat(self):
+        self.size = len(self.obj)
+        self.mtime = self.ctime = self.obj.mtime
+        return super().stat()